@@ -13,25 +13,56 @@
 # nuitka-project: --product-version=1.0.0
 # nuitka-project: --copyright="© 2020-2026 WiiLink Team. All rights reserved."
 # nuitka-project: --plugin-enable=pyside6
-# nuitka-project: --include-package-data=PySide6:*.qm
 # nuitka-project: --include-data-dir={MAIN_DIRECTORY}/assets=assets
+# nuitka-project: --include-data-file={MAIN_DIRECTORY}/resources.rcc=resources.rcc
 # nuitka-project: --include-data-file={MAIN_DIRECTORY}/style.qss=style.qss
-# nuitka-project: --include-data-file={MAIN_DIRECTORY}/translations/languages.json=translations/languages.json
+# keyring is imported lazily and finds its backends through its package metadata
+# nuitka-project: --include-package=keyring
+# nuitka-project: --include-distribution-metadata=keyring
+# psutil is imported lazily by supervisor.py
+# nuitka-project: --include-package=psutil
+import asyncio
+import time
+
+# Taken before the heavy imports so time to first window covers the whole launch
+launch_time = time.perf_counter()
+
 import os
+import signal
+import socket
 import sys
-import datetime
-import random
 import traceback
 import webbrowser
-import json
-import nodriver
-import requests
-
-from constants import file_path, linker_version
+import deadlines
+import endpoints
+import profiling
+import resources
+import storage
+import supervisor
+import tracing
+
+from constants import linker_version
+from linking import (
+    browser_profile_dir,
+    forget_session,
+    format_wii_number,
+    persistent_browser_profiles,
+    prefetch_login_urls,
+    request_device_code,
+    restore_session,
+)
 from oauth import WiiLinkAccountPage, WiiNumberSelector
+from releases import get_latest_version
 from just_eat import JustEatCredentialsPage, CountrySelect
-from PySide6.QtCore import Qt, QTimer, QLocale, QLibraryInfo, QTranslator
-from PySide6.QtGui import QIcon
+from workers import BackgroundTask
+from PySide6.QtCore import (
+    Qt,
+    QTimer,
+    QLocale,
+    QLibraryInfo,
+    QSocketNotifier,
+    QTranslator,
+)
 from PySide6.QtWidgets import (
     QWizard,
     QWizardPage,
@@ -41,25 +72,19 @@ from PySide6.QtWidgets import (
     QMessageBox,
     QDialog,
     QComboBox,
+    QListWidget,
+    QListWidgetItem,
     QPushButton,
 )
 
+profiling.record("imports", time.perf_counter() - launch_time)
 
-def get_latest_version() -> str:
-    """Gets the tag of the latest stable release from the GitHub API
 
-    Returns:
-        The latest tag from the GitHub API"""
-    api_url = "https://api.github.com/repos/WiiLink24/JustEatLinker/releases/latest"
+def probe_browser():
+    """Checks that nodriver can find a browser, importing nodriver off the GUI thread"""
+    import nodriver
 
-    api_response_raw = requests.get(api_url)
-    api_response_raw.raise_for_status()
-
-    api_response = json.loads(api_response_raw)
-
-    latest_version = api_response["tag_name"].replace("v", "")
-
-    return latest_version
+    nodriver.Config()
 
 
 class IntroPage(QWizardPage):
@@ -85,12 +110,25 @@ Press 'Next' to get started!"""))
 
         self.setLayout(self.layout)
 
+    def validatePage(self):
+        # The flow budget, see deadlines.py, starts once the user does. Time spent on
+        # this page before pressing Next, e.g. a kiosk left idle, doesn't count.
+        deadlines.start("flow")
+        return True
+
+    def nextId(self):
+        # A restored WiiLink session skips the device code login
+        if self.wizard().property("access_token"):
+            return 2
+        return 1
+
 
 class FinalPage(QWizardPage):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.layout = QVBoxLayout()
 
+    @tracing.traced("FinalPage.initializePage", "page")
     def initializePage(self):
         QTimer.singleShot(0, self.disable_back_button)
 
@@ -98,15 +136,41 @@ class FinalPage(QWizardPage):
         self.setSubTitle(
             self.tr("Your Just Eat account has been linked to your WiiLink account!")
         )
-        self.label = QLabel(
-            self.tr(
-                """Your Just Eat account has successfully been linked to the Wii with number <strong>{}</strong>.</br></br>
+
+        results = self.wizard().property("link_results")
+        if len(results) == 1:
+            self.label = QLabel(
+                self.tr(
+                    """Your Just Eat account has successfully been linked to the Wii with number <strong>{}</strong>.</br></br>
 
 Enjoy ordering food on your Wii!"""
-            ).format(self.wizard().property("wii_no_fancy"))
+                ).format(format_wii_number(results[0]["wii_number"]))
+            )
+            self.label.setWordWrap(True)
+            self.layout.addWidget(self.label)
+            self.setLayout(self.layout)
+            return
+
+        linked = sum(1 for result in results if result["error"] is None)
+        self.label = QLabel(
+            self.tr(
+                """Your Just Eat account has been linked to {} of {} Wiis. Enjoy ordering food on your Wii!"""
+            ).format(linked, len(results))
         )
         self.label.setWordWrap(True)
         self.layout.addWidget(self.label)
+
+        # One row per console, the error is shown when hovering a console that failed
+        summary = QListWidget()
+        for result in results:
+            wii_no_fancy = format_wii_number(result["wii_number"])
+            if result["error"] is None:
+                item = QListWidgetItem(self.tr("{} - linked").format(wii_no_fancy))
+            else:
+                item = QListWidgetItem(self.tr("{} - failed").format(wii_no_fancy))
+                item.setToolTip(result["error"])
+            summary.addItem(item)
+        self.layout.addWidget(summary)
         self.setLayout(self.layout)
 
     def disable_back_button(self):
@@ -115,71 +179,80 @@ Enjoy ordering food on your Wii!"""
 
 class JustEatLinker(QWizard):
     language = QLocale("en")
+    # Set by --select-language, to show the language selector even if one was saved
+    select_language = False
+    time_to_first_window: float = None
+    # Set by --profile-startup, "" to only print the report or a path to also dump it
+    profile_output: str = None
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        # Load in images
-        icon = QIcon(file_path.joinpath("assets", "logo.webp").resolve().as_posix())
-        just_eat_icon = QIcon(
-            file_path.joinpath("assets", "just_eat_logo.webp").resolve().as_posix()
+        # Network and browser probes run in the background while the window is built.
+        # Anything that needs to show a dialog is deferred until the window is visible.
+        self.background_tasks = []
+        self.pending_tasks = 0
+        self.deferred_until_shown = []
+
+        # Started first so every request below waits for the mirror it should use,
+        # a no-op unless several candidates are configured for a service
+        self.run_in_background(
+            profiling.timed("endpoint probe", endpoints.probe_all), None, None
         )
 
-        match datetime.datetime.now().month:
-            case 6:
-                pride_flags = file_path.joinpath("assets", "pride_banners").iterdir()
-                flags_list = list(pride_flags)
-
-                flag_index = random.randint(0, len(flags_list) - 1)
-                selected_flag = flags_list[flag_index]
-
-                background = QIcon(selected_flag.resolve().as_posix())
-            case _:
-                background = QIcon(
-                    file_path.joinpath("assets", "background.webp").resolve().as_posix()
-                )
-
-        just_eat_pixmap = just_eat_icon.pixmap(64, 64)
-        banner = background.pixmap(700, 120)
-        self.setPixmap(QWizard.WizardPixmap.LogoPixmap, just_eat_pixmap)
-        self.setPixmap(QWizard.WizardPixmap.BannerPixmap, banner)
-
-        self.setWindowIcon(icon)
-
-        # Apply global stylesheet for consistent styling across all pages
-        stylesheet_path = file_path.joinpath("style.qss")
-        stylesheet = open(stylesheet_path, "r").read()
-        stylesheet = stylesheet.replace(
-            "%AssetsDir%",
-            file_path.joinpath("assets").resolve().as_posix(),
+        # A session saved by an earlier launch is tried first, the device code is only
+        # requested if there is none
+        self.run_in_background(
+            profiling.timed("session restore", restore_session),
+            self.session_restored,
+            self.session_restore_failed,
         )
-        self.setStyleSheet(stylesheet)
 
         if "Nightly" not in linker_version and "RC" not in linker_version:
-            self.check_for_updates()
-
-        self.language_selector = LanguageSelector()
-        self.translation_setup()
+            self.run_in_background(
+                profiling.timed("update check", get_latest_version),
+                self.update_check_finished,
+                self.update_check_failed,
+            )
 
-        if not os.getenv("WIILINK_BROWSER_PATH"):
-            try:
-                nodriver.Config()
-            except FileNotFoundError:
-                QMessageBox.critical(
-                    self,
-                    self.tr("Browser not found"),
-                    self.tr(
-                        """To use this app, you need to have Chromium, Google Chrome, or Microsoft Edge installed.
+        self.run_in_background(
+            profiling.timed("login URL prefetch", prefetch_login_urls),
+            None,
+            None,
+            list(CountrySelect.countries.values()),
+        )
 
-If you are on Linux, the browser also needs to be accessible on the system PATH.
+        self.run_in_background(
+            profiling.timed("browser reap", supervisor.reap_leaked_browsers),
+            None,
+            None,
+        )
 
-If you are using Linux and do not wish to install a browser as a system package, you can download and extract a browser, then pass the full path to this app with the environment variable `WIILINK_BROWSER_PATH`."""
-                    ),
-                )
-                sys.exit(1)
+        if not os.getenv("WIILINK_BROWSER_PATH"):
+            self.run_in_background(
+                profiling.timed("browser probe", probe_browser),
+                None,
+                self.browser_probe_failed,
+            )
         else:
             self.setProperty("browser", os.getenv("WIILINK_BROWSER_PATH"))
 
+        # Load in images, pre-rendered at these sizes by build_assets.py when available
+        with profiling.phase("asset decode"):
+            self.setPixmap(QWizard.WizardPixmap.LogoPixmap, resources.just_eat_logo())
+            self.setPixmap(QWizard.WizardPixmap.BannerPixmap, resources.banner())
+
+            # Set once for the whole app so LanguageSelector doesn't decode it again
+            QApplication.setWindowIcon(resources.window_icon())
+
+        # Apply global stylesheet for consistent styling across all pages. It's set on
+        # the application once so every window, LanguageSelector too, shares one parse.
+        with profiling.phase("stylesheet"):
+            QApplication.instance().setStyleSheet(resources.stylesheet())
+
+        with profiling.phase("language setup"):
+            self.translation_setup()
+
         self.setWindowTitle(self.tr("WiiLink Just Eat Linker"))
         self.setWizardStyle(QWizard.WizardStyle.ModernStyle)
         self.setSubTitleFormat(Qt.TextFormat.RichText)
@@ -189,112 +262,290 @@ If you are using Linux and do not wish to install a browser as a system package,
 
         self.setButtonText(QWizard.WizardButton.NextButton, self.tr("Next"))
         self.setButtonText(QWizard.WizardButton.BackButton, self.tr("Back"))
-
-        self.setPage(0, IntroPage())
-        # Skip for now
-        self.setPage(1, WiiLinkAccountPage())
-        self.setPage(2, WiiNumberSelector())
-        self.setPage(3, CountrySelect())
-        self.setPage(4, JustEatCredentialsPage())
-        self.setPage(5, FinalPage())
+        self.setButtonText(QWizard.WizardButton.CancelButton, self.tr("Cancel"))
+
+        with profiling.phase("page construction"):
+            self.setPage(0, IntroPage())
+            # Skip for now
+            self.account_page = WiiLinkAccountPage()
+            # Cancel and closing the window stop every stage still running, so no
+            # browser, socket or poll outlives the wizard
+            self.finished.connect(self.cancel_background_tasks)
+            self.finished.connect(self.discard_prewarmed_browser)
+            self.currentIdChanged.connect(self.page_changed)
+            self.setPage(1, self.account_page)
+            self.setPage(2, WiiNumberSelector())
+            self.setPage(3, CountrySelect())
+            self.setPage(4, JustEatCredentialsPage())
+            self.setPage(5, FinalPage())
 
         self.setStartId(0)
 
+        # Showing the window polishes every page anyway, doing it here lets it be timed
+        with profiling.phase("stylesheet polish"):
+            self.ensurePolished()
+
     def translation_setup(self):
-        """Static method to load patcher translations for the user's language if they exist
+        """Loads translations for the user's language if they exist
+
+        The saved language is used, or the system language if there is a catalogue for
+        it. The language selector is only shown when neither is available.
 
         Returns:
             None"""
+        settings_path = storage.settings_path()
+        settings = storage.read_json(settings_path, {})
+        available = resources.available_languages()
+
+        language = settings.get("language")
+        if language not in available:
+            system_language = QLocale.system().language()
+            language = next(
+                (
+                    name
+                    for name in available
+                    if QLocale(name).language() == system_language
+                ),
+                None,
+            )
 
-        self.language_selector.exec()
+        if language is None or self.select_language:
+            language_selector = LanguageSelector()
+            language_selector.exec()
+            settings["language"] = language_selector.selected_language
+            storage.write_json(settings_path, settings)
+        else:
+            JustEatLinker.language = QLocale(language)
 
-        path = QLibraryInfo.path(QLibraryInfo.LibraryPath.TranslationsPath)
+        # The wizard may be built by another module, e.g. benchmark.py, so the
+        # application isn't necessarily this module's global
+        app = QApplication.instance()
+        path = resources.translations_dir()
         translator = QTranslator(app)
-        if translator.load(self.language, "qtbase", "_", path):
+        if translator.load(self.language, "qtbase", "_", path) or translator.load(
+            self.language,
+            "qtbase",
+            "_",
+            QLibraryInfo.path(QLibraryInfo.LibraryPath.TranslationsPath),
+        ):
             app.installTranslator(translator)
 
         translator = QTranslator(app)
-        path = file_path.joinpath("translations").resolve().as_posix()
         if translator.load(self.language, "translation", "_", path):
             app.installTranslator(translator)
 
-    def check_for_updates(self):
-        """Static method to compare the current patcher version to the latest, and inform the user if they aren't up to date
+    def run_in_background(self, function, on_finished, on_error, *args):
+        """Starts a blocking startup task on the runtime, the callbacks run on the GUI thread
 
         Returns:
             None"""
-        try:
-            latest_version = get_latest_version()
-        except:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
-            QMessageBox.warning(
+        task = BackgroundTask(function, *args, stage="startup")
+        task.finished.connect(self.background_task_received)
+        task.error.connect(self.background_task_received)
+        if on_finished is not None:
+            task.finished.connect(on_finished)
+        if on_error is not None:
+            task.error.connect(on_error)
+        task.finished.connect(self.background_task_done)
+        task.error.connect(self.background_task_done)
+        self.pending_tasks += 1
+        self.background_tasks.append(task)
+        task.start()
+
+    def background_task_received(self, _result):
+        tracing.handoff_received(self.sender().handoff)
+
+    def background_task_done(self, _result):
+        self.pending_tasks -= 1
+        self.finish_startup_profile()
+
+    def finish_startup_profile(self):
+        """Prints the --profile-startup report and quits once the window is up and every
+        startup task has finished
+
+        Returns:
+            None"""
+        if self.profile_output is None or self.time_to_first_window is None:
+            return
+        if self.pending_tasks > 0:
+            return
+
+        print(profiling.report())
+        if self.profile_output:
+            profiling.dump(self.profile_output)
+        self.profile_output = None
+        QTimer.singleShot(0, QApplication.instance().quit)
+
+    def run_when_shown(self, function):
+        if self.time_to_first_window is None:
+            self.deferred_until_shown.append(function)
+        else:
+            function()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+
+        if self.time_to_first_window is None:
+            self.time_to_first_window = time.perf_counter() - launch_time
+            profiling.record("time to first window", self.time_to_first_window)
+            print(f"Time to first window: {self.time_to_first_window * 1000:.0f} ms")
+
+            for function in self.deferred_until_shown:
+                QTimer.singleShot(0, function)
+            self.deferred_until_shown.clear()
+
+            self.finish_startup_profile()
+
+    def page_changed(self, page_id: int):
+        tracing.instant(f"page {page_id}", "page")
+
+        # Opt-in: start the browser while the user logs in to WiiLink, so the Just Eat
+        # page doesn't have to wait for Chromium to cold start. A persistent browser
+        # profile belongs to an account, so then the browser waits for the login.
+        access_token = self.property("access_token")
+        if (
+            page_id in (1, 2)
+            and os.getenv("WIILINK_PREWARM_BROWSER") == "1"
+            and self.property("browser_prewarmer") is None
+            and (access_token or not persistent_browser_profiles)
+        ):
+            from browser import BrowserPrewarmer
+
+            prewarmer = BrowserPrewarmer(
+                self.property("browser"), browser_profile_dir(access_token)
+            )
+            prewarmer.start()
+            self.setProperty("browser_prewarmer", prewarmer)
+
+    def cancel_background_tasks(self):
+        BackgroundTask.cancel_all()
+
+    def discard_prewarmed_browser(self):
+        prewarmer = self.property("browser_prewarmer")
+        if prewarmer is not None:
+            prewarmer.discard()
+
+    def session_restored(self, data: dict):
+        if data is None:
+            self.request_device_code()
+            return
+
+        print("Restored the WiiLink session from the last launch")
+        self.run_when_shown(lambda: self.account_page.set_session(data))
+
+    def session_restore_failed(self, error: Exception):
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        self.request_device_code()
+
+    def request_device_code(self):
+        self.run_in_background(
+            profiling.timed("device code request", request_device_code),
+            self.device_code_ready,
+            self.device_code_failed,
+        )
+
+    def device_code_ready(self, data: dict):
+        # The pages are only built after the language is chosen, so wait until shown
+        self.run_when_shown(lambda: self.account_page.set_device_data(data))
+
+    def device_code_failed(self, error: Exception):
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        self.run_when_shown(lambda: self.account_page.device_data_failed(error))
+
+    def browser_probe_failed(self, error: Exception):
+        if not isinstance(error, FileNotFoundError):
+            # Anything but a missing browser is left for the browser launch to report
+            return
+
+        QMessageBox.critical(
+            self,
+            self.tr("Browser not found"),
+            self.tr(
+                """To use this app, you need to have Chromium, Google Chrome, or Microsoft Edge installed.
+
+If you are on Linux, the browser also needs to be accessible on the system PATH.
+
+If you are using Linux and do not wish to install a browser as a system package, you can download and extract a browser, then pass the full path to this app with the environment variable `WIILINK_BROWSER_PATH`."""
+            ),
+        )
+        sys.exit(1)
+
+    def update_check_failed(self, error: Exception):
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        exception_traceback = "".join(traceback.format_exception(error))
+        self.run_when_shown(
+            lambda: QMessageBox.warning(
                 self,
                 "WiiLink Just Eat Linker - Warning",
                 f"""Unable to check for updates!
 
 {exception_traceback}""",
             )
+        )
+
+    def update_check_finished(self, latest_version: str):
+        """Compares the current linker version to the latest, and informs the user if they aren't up to date
+
+        Returns:
+            None"""
+        latest_version_split = latest_version.split(".")
+        linker_version_split = linker_version.split(".")
+
+        to_update = False
+
+        if len(latest_version_split) == len(linker_version_split):
+            for place in range(len(latest_version_split)):
+                if latest_version_split[place] > linker_version_split[place]:
+                    to_update = True
+                    break
+                elif latest_version_split[place] < linker_version_split[place]:
+                    break
         else:
-            latest_version_split = latest_version.split(".")
-            linker_version_split = linker_version.split(".")
-
-            to_update = False
-
-            if len(latest_version_split) == len(linker_version_split):
-                for place in range(len(latest_version_split)):
-                    if latest_version_split[place] > linker_version_split[place]:
-                        to_update = True
-                        break
-                    elif latest_version_split[place] < linker_version_split[place]:
-                        break
-            else:
-                to_update = True
+            to_update = True
+
+        if to_update:
+            self.run_when_shown(lambda: self.prompt_update(latest_version))
 
-            if to_update:
-                update = QMessageBox.question(
-                    self,
-                    "WiiLink Just Eat Linker - Update",
-                    f"""An update has been detected for the linker, would you like to download it?
+    def prompt_update(self, latest_version: str):
+        update = QMessageBox.question(
+            self,
+            "WiiLink Just Eat Linker - Update",
+            f"""An update has been detected for the linker, would you like to download it?
 
 Your version: {linker_version}
 Latest version: {latest_version}""",
-                )
-                if update == QMessageBox.StandardButton.Yes:
-                    webbrowser.open(
-                        "https://github.com/WiiLink24/JustEatLinker/releases/latest"
-                    )
-                    sys.exit()
+        )
+        if update == QMessageBox.StandardButton.Yes:
+            webbrowser.open(
+                "https://github.com/WiiLink24/JustEatLinker/releases/latest"
+            )
+            sys.exit()
 
 
 class LanguageSelector(QDialog):
+    # Kept if the dialog is closed without pressing Done
+    selected_language = "en"
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("WiiLink Just Eat Linker - Select Language")
         self.setFixedWidth(450)
         self.setFixedHeight(150)
 
-        # Set background color to match main app
-        stylesheet = file_path.joinpath("style.qss").read_text()
-        stylesheet = stylesheet.replace(
-            "%AssetsDir%",
-            file_path.joinpath("assets").resolve().as_posix(),
-        )
-        self.setStyleSheet(stylesheet)
         self.layout = QVBoxLayout()
 
-        icon = QIcon(file_path.joinpath("assets", "logo.webp").resolve().as_posix())
-        self.setWindowIcon(icon)
-
         label = QLabel(
             "Select the language you'd like to use the linker in from the list below:"
         )
         label.setWordWrap(True)
         self.layout.addWidget(label)
-        language_json = file_path.joinpath("translations", "languages.json").read_text(
-            encoding="utf-8"
-        )
-        self.language_names = json.loads(language_json)
+        self.language_names = resources.language_names()
 
         self.language_dropdown = QComboBox()
         self.language_dropdown.addItems(self.language_names.keys())
@@ -308,13 +559,57 @@ class LanguageSelector(QDialog):
 
     def set_language(self):
         selected_name = self.language_dropdown.currentText()
-        selected_language = self.language_names[selected_name]
-        JustEatLinker.language = QLocale(selected_language)
+        self.selected_language = self.language_names[selected_name]
+        JustEatLinker.language = QLocale(self.selected_language)
         self.destroy()
 
 
+def wake_on_signals(app: QApplication):
+    """Lets Python signal handlers, like the supervisor's, run while Qt's event loop
+    has the main thread. Python only runs them once it executes bytecode again, so the
+    C level handler writes to a socket that wakes the event loop.
+
+    Returns:
+        None"""
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+    writer.setblocking(False)
+    signal.set_wakeup_fd(writer.fileno())
+
+    def drain():
+        # Any Python code will do, the pending handlers run before this returns
+        try:
+            reader.recv(64)
+        except OSError:
+            pass
+
+    notifier = QSocketNotifier(reader.fileno(), QSocketNotifier.Type.Read, app)
+    notifier.activated.connect(drain)
+    # Kept alive as long as the app
+    app.signal_wakeup = (reader, writer, notifier)
+
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    if any(arg == "--batch" or arg.startswith("--batch=") for arg in sys.argv):
+        import batch
+
+        sys.exit(batch.main(sys.argv[1:]))
+
+    for arg in sys.argv:
+        if arg.startswith("--profile-startup"):
+            JustEatLinker.profile_output = arg.partition("=")[2]
+        elif arg == "--select-language":
+            JustEatLinker.select_language = True
+        elif arg == "--logout":
+            # Before the wizard is built, it restores the saved session right away
+            forget_session()
+            print("Signed out of the saved WiiLink session")
+
+    supervisor.install_signal_handlers()
+
+    with profiling.phase("QApplication creation"):
+        app = QApplication(sys.argv)
+    wake_on_signals(app)
     wizard = JustEatLinker()
 
     wizard.show()
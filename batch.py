@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import deadlines
+import json
+import os
+import sys
+import time
+import traceback
+import endpoints
+import http_client
+import supervisor
+
+from dataclasses import dataclass
+from browser import TokenCapture
+from linking import (
+    DeviceCodePoller,
+    browser_profile_dir,
+    format_wii_number,
+    get_login_urls,
+    link_to_server,
+    make_acr,
+    request_device_code,
+)
+
+
+@dataclass
+class BatchJob:
+    """A single console to link. Without an access_token the WiiLink login is done with the device code flow."""
+
+    name: str
+    wii_number: int
+    country: str
+    access_token: str = None
+
+
+@dataclass
+class JobResult:
+    job: BatchJob
+    success: bool
+    latency: float
+    error: str = None
+
+
+def load_jobs(path: str) -> list[BatchJob]:
+    """Loads batch jobs from a JSON file containing a list of objects with "wii_number" and "country" keys
+
+    Returns:
+        The parsed jobs"""
+    with open(path, "r", encoding="utf-8") as jobs_file:
+        raw_jobs = json.load(jobs_file)
+
+    jobs = []
+    for index, raw_job in enumerate(raw_jobs):
+        jobs.append(
+            BatchJob(
+                name=raw_job.get("name", f"job {index + 1}"),
+                wii_number=int(raw_job["wii_number"]),
+                country=raw_job["country"],
+                access_token=raw_job.get("access_token"),
+            )
+        )
+
+    return jobs
+
+
+async def login_wiilink(job: BatchJob) -> str:
+    """Runs the device code flow for a job, printing the code the operator has to enter
+
+    Returns:
+        The WiiLink access token"""
+    data = await asyncio.to_thread(request_device_code)
+    print(
+        f"[{job.name}] Visit {data['verification_uri']}?code={data['user_code']} and enter the code {data['user_code']}"
+    )
+
+    poller = DeviceCodePoller(data["device_code"], data["interval"], data["expires_in"])
+    token = await poller.poll()
+
+    print(f"[{job.name}] {poller.summary()}")
+    return token["access_token"]
+
+
+async def run_job(
+    job: BatchJob, semaphore: asyncio.Semaphore, browser_path: str = None
+) -> JobResult:
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            # The flow budget starts once the job gets its turn
+            deadlines.start("flow")
+            access_token = job.access_token or await login_wiilink(job)
+            login_urls = await asyncio.to_thread(get_login_urls, job.country)
+
+            print(f"[{job.name}] Login to Just Eat in the browser that opens")
+            # Jobs of one account running at once can't share its browser profile,
+            # the ones started later get a temporary profile
+            capture = TokenCapture(
+                login_urls["eater_url"],
+                login_urls["token_url"],
+                browser_path,
+                user_data_dir=browser_profile_dir(access_token),
+            )
+            token = await capture.run()
+
+            device_id, acr = make_acr(job.country)
+            resp = await asyncio.to_thread(
+                link_to_server, token, job.wii_number, access_token, device_id, acr
+            )
+            resp.raise_for_status()
+        except Exception as e:
+            print(traceback.format_exc())
+            return JobResult(job, False, time.perf_counter() - start, str(e))
+
+        return JobResult(job, True, time.perf_counter() - start)
+
+
+async def run_batch(
+    jobs: list[BatchJob], concurrency: int, browser_path: str = None
+) -> list[JobResult]:
+    """Runs the link flow for every job, with at most `concurrency` jobs in flight
+
+    Returns:
+        The result of every job, in the same order as the jobs"""
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *(run_job(job, semaphore, browser_path) for job in jobs)
+    )
+
+
+def print_report(results: list[JobResult], elapsed: float):
+    for result in results:
+        status = "linked" if result.success else f"failed ({result.error})"
+        print(
+            f"{result.job.name}: {format_wii_number(result.job.wii_number)} {status} in {result.latency:.2f}s"
+        )
+
+    succeeded = sum(1 for result in results if result.success)
+    throughput = succeeded / elapsed * 60 if elapsed > 0 else 0
+    print(
+        f"{succeeded}/{len(results)} consoles linked in {elapsed:.2f}s ({throughput:.2f} links/minute)"
+    )
+
+    for host, stats in http_client.connection_stats().items():
+        print(
+            f"{host}: {stats['requests']} requests over {stats['connections']} connections ({stats['reused']} reused)"
+        )
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Link several Wii consoles to Just Eat without the wizard."
+    )
+    parser.add_argument("--batch", required=True, help="path to the jobs JSON file")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="maximum number of link flows running at once (default: 4)",
+    )
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.batch)
+    supervisor.install_signal_handlers()
+    supervisor.reap_leaked_browsers()
+
+    asyncio.run(endpoints.probe_all())
+    start = time.perf_counter()
+    results = asyncio.run(
+        run_batch(jobs, max(1, args.concurrency), os.getenv("WIILINK_BROWSER_PATH"))
+    )
+    print_report(results, time.perf_counter() - start)
+
+    return 0 if all(result.success for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,502 @@
+# End-to-end benchmark of the linker against local stand-ins for every server it talks to. It drives the real
+# JustEatLinker wizard on the offscreen Qt platform through every page, including the Chromium login, and reports
+# latency percentiles for each stage, so builds can be compared on a box without network access.
+
+# A browser is still required, on a machine without a display run this under xvfb-run. Its launch time and, with
+# psutil installed, its peak memory use are reported too. Pass several launch profiles to --browser-profile to
+# compare them, e.g. --browser-profile default lean, each one is run for the given number of iterations.
+
+# Usage:
+# python benchmark.py [--iterations N] [--latency MS] [--jitter MS] [--error-rate FRACTION] [--pending-polls N]
+#                     [--consoles N] [--link-all] [--warm-cache] [--browser-profile PROFILE ...]
+#                     [--output results.json]
+
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import QApplication, QPushButton
+
+# The stand-in login page posts to the token URL shortly after loading, like a user logging in
+eater_page = """<!DOCTYPE html>
+<html>
+<body>
+<p>Just Eat stand-in login</p>
+<script>
+setTimeout(() => fetch("/token", {
+    method: "POST",
+    headers: {"Content-Type": "application/x-www-form-urlencoded"},
+    body: "grant_type=password&username=benchmark",
+}), 200);
+</script>
+</body>
+</html>
+"""
+# Loaded by Chromium, which doesn't retry, so an injected error would stall the login
+browser_paths = ("/eater", "/token")
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Serves the SSO, accounts, Just Eat and GitHub endpoints the linker uses.
+
+    `latency` and `jitter` are in seconds and are added to every response. GET requests
+    other than the browser's fail with a 503 with probability `error_rate`, the linker
+    retries those."""
+
+    daemon_threads = True
+
+    def __init__(self, latency, jitter, error_rate, pending_polls, consoles):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pending_polls = pending_polls
+        self.consoles = consoles
+        self.polls = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandInServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_form(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        return {key: values[0] for key, values in form.items()}
+
+    def delay(self):
+        jitter = random.uniform(0, self.server.jitter)
+        time.sleep(max(0.0, self.server.latency + jitter))
+
+    def do_GET(self):
+        self.delay()
+        url = urlparse(self.path)
+
+        if url.path not in browser_paths and random.random() < self.server.error_rate:
+            self.send_json({"error": "injected"}, 503)
+        elif url.path == "/link/user":
+            wiis = [
+                {"wii_number": 1000000000000000 + index}
+                for index in range(self.server.consoles)
+            ]
+            self.send_json({"attributes": {"wiis": wiis}})
+        elif url.path == "/loginurls.json":
+            self.send_json(
+                {
+                    "eater_url": f"{self.server.base_url}/eater",
+                    "token_url": f"{self.server.base_url}/token",
+                }
+            )
+        elif url.path == "/eater":
+            body = eater_page.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path.endswith("/releases/latest"):
+            if self.headers.get("If-None-Match") == '"benchmark"':
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_json({"tag_name": "v0.0.0"}, headers={"ETag": '"benchmark"'})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        self.delay()
+        url = urlparse(self.path)
+        form = self.read_form()
+
+        if url.path == "/application/o/device/":
+            device_code = os.urandom(8).hex()
+            self.send_json(
+                {
+                    "device_code": device_code,
+                    "user_code": "BENCH-MARK",
+                    "verification_uri": f"{self.server.base_url}/device",
+                    "interval": 1,
+                    "expires_in": 600,
+                }
+            )
+        elif url.path == "/application/o/token/":
+            with self.server.lock:
+                polls = self.server.polls.get(form.get("device_code"), 0) + 1
+                self.server.polls[form.get("device_code")] = polls
+
+            if polls <= self.server.pending_polls:
+                self.send_json({"error": "authorization_pending"}, 400)
+            else:
+                self.send_json(
+                    {"access_token": "benchmark-sso-token", "expires_in": 3600}
+                )
+        elif url.path == "/token":
+            self.send_json(
+                {
+                    "access_token": "benchmark-just-eat-token",
+                    "refresh_token": "benchmark-refresh-token",
+                    "expires_in": 3600,
+                }
+            )
+        elif url.path == "/link":
+            self.send_json({"success": True})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+
+class WizardDriver:
+    """Runs the wizard once, pressing Next on every page that waits for the user and
+    timing each stage"""
+
+    def __init__(self, app, on_done, link_all=False):
+        import supervisor
+        from JustEatLinker import JustEatLinker
+
+        # Every browser launched from now on belongs to this run
+        self.sessions = supervisor.sessions
+
+        self.app = app
+        self.on_done = on_done
+        self.link_all = link_all
+        self.stages = {}
+        self.marks = {}
+
+        self.first_session = len(self.sessions)
+        self.memory = None
+
+        self.mark("start")
+        self.wizard = JustEatLinker()
+        self.wizard.currentIdChanged.connect(self.page_changed)
+
+        account_page = self.wizard.page(1)
+        account_page.completeChanged.connect(self.wiilink_login_done)
+
+        self.console_page = self.wizard.page(2)
+        self.console_page.completeChanged.connect(self.console_list_done)
+
+        credentials_page = self.wizard.page(4)
+        credentials_page.browser_worker.token_signal.connect(self.token_captured)
+
+        self.wizard.show()
+        self.app.processEvents()
+        self.stage("startup", "start")
+
+    def mark(self, name: str):
+        self.marks[name] = time.perf_counter()
+
+    def stage(self, name: str, since: str):
+        self.stages[name] = time.perf_counter() - self.marks[since]
+
+    def wiilink_login_done(self):
+        self.mark("wiilink login done")
+        self.stage("wiilink login", "page 1")
+
+    def console_list_done(self):
+        if not self.console_page.isComplete() or "console list" in self.stages:
+            return
+
+        self.mark("console list done")
+        self.stage("console list", "page 2")
+
+        if self.link_all:
+            model = self.console_page.model
+            for row in range(model.rowCount()):
+                model.setData(
+                    model.index(row),
+                    Qt.CheckState.Checked,
+                    Qt.ItemDataRole.CheckStateRole,
+                )
+        QTimer.singleShot(0, self.wizard.next)
+
+    def token_captured(self, _token: dict):
+        self.mark("just eat token")
+        self.stage("browser login", "page 4")
+
+        # The browser that logged in is still open, its peak covers the login page load
+        sessions = self.sessions[self.first_session :]
+        if not sessions:
+            return
+
+        session = sessions[-1]
+        if session.launch_time is not None:
+            self.stages["browser launch"] = session.launch_time
+        if session.root is not None:
+            self.memory = {
+                "peak RSS": session.peak_rss / 2**20,
+                "processes": session.peak_processes,
+            }
+
+    def page_changed(self, page_id: int):
+        self.mark(f"page {page_id}")
+        match page_id:
+            case 2:
+                # The console list loads in the background, see console_list_done
+                return
+            case 3:
+                self.stage("country select", "console list done")
+            case 4:
+                # Includes looking up the login URLs in initializePage
+                self.stage("login URLs", "page 3")
+            case 5:
+                self.stage("link", "just eat token")
+                self.stage("total", "start")
+
+                self.wizard.finished.connect(lambda _result: self.on_done(self))
+                QTimer.singleShot(0, self.wizard.accept)
+                return
+
+        if page_id in (0, 3):
+            QTimer.singleShot(0, self.wizard.next)
+
+
+def dismiss_modal_dialogs():
+    """Closes any message box or the language selector so the run never blocks on them"""
+    dialog = QApplication.activeModalWidget()
+    if dialog is None:
+        return
+
+    done_buttons = [
+        button for button in dialog.findChildren(QPushButton) if button.text() == "Done"
+    ]
+    if done_buttons:
+        done_buttons[0].click()
+    else:
+        print(f"Dismissed dialog: {dialog.windowTitle()}", file=sys.stderr)
+        dialog.close()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def report(results: list[dict]) -> dict:
+    if not results:
+        print("No iteration finished")
+        return {}
+
+    summary = {}
+    for stage in results[0]:
+        values = [result[stage] * 1000 for result in results if stage in result]
+        summary[stage] = {
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "mean": statistics.fmean(values),
+        }
+
+    print(f"{'stage':<18}{'p50':>10}{'p90':>10}{'p99':>10}{'mean':>10}  (ms)")
+    for stage, values in summary.items():
+        print(
+            f"{stage:<18}{values['p50']:>10.1f}{values['p90']:>10.1f}"
+            f"{values['p99']:>10.1f}{values['mean']:>10.1f}"
+        )
+
+    return summary
+
+
+def report_memory(memory: list[dict]) -> dict:
+    if not memory:
+        print("Browser memory: not measured, install psutil")
+        return {}
+
+    peak_rss = [sample["peak RSS"] for sample in memory]
+    summary = {
+        "peak RSS p50": percentile(peak_rss, 0.5),
+        "peak RSS max": max(peak_rss),
+        "peak RSS mean": statistics.fmean(peak_rss),
+        "processes max": max(sample["processes"] for sample in memory),
+    }
+    print(
+        f"Browser memory: peak RSS p50 {summary['peak RSS p50']:.1f} MB, "
+        f"max {summary['peak RSS max']:.1f} MB, "
+        f"up to {summary['processes max']} processes"
+    )
+
+    return summary
+
+
+def compare(baseline: str, summaries: dict):
+    """Prints the launch time and memory use of every profile against the first one"""
+    base = summaries[baseline]
+    for profile, summary in summaries.items():
+        if profile == baseline:
+            continue
+
+        changes = []
+        if "browser launch" in summary and "browser launch" in base:
+            before = base["browser launch"]["mean"]
+            after = summary["browser launch"]["mean"]
+            changes.append(
+                f"launch {after - before:+.0f} ms ({after / before - 1:+.0%})"
+            )
+        if summary["browser memory"] and base["browser memory"]:
+            before = base["browser memory"]["peak RSS mean"]
+            after = summary["browser memory"]["peak RSS mean"]
+            changes.append(
+                f"peak RSS {after - before:+.1f} MB ({after / before - 1:+.0%})"
+            )
+        print(f"{profile} vs {baseline}: {', '.join(changes) or 'not measured'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the linker against local stand-in servers."
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0, help="ms per response")
+    parser.add_argument("--jitter", type=float, default=0, help="extra random ms")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of GETs failed with 503"
+    )
+    parser.add_argument(
+        "--pending-polls",
+        type=int,
+        default=1,
+        help="authorization_pending answers before the SSO login succeeds",
+    )
+    parser.add_argument("--consoles", type=int, default=1)
+    parser.add_argument(
+        "--link-all",
+        action="store_true",
+        help="link every console at once instead of only the first",
+    )
+    parser.add_argument(
+        "--warm-cache",
+        action="store_true",
+        help="keep the on-disk caches between iterations",
+    )
+    parser.add_argument(
+        "--browser-profile",
+        nargs="+",
+        default=["default"],
+        help="browser launch profiles to run, compared against the first one",
+    )
+    parser.add_argument("--output", help="write the percentiles to a JSON file")
+    args = parser.parse_args()
+
+    # Sample the browser's memory often enough not to miss the login page's peak
+    os.environ.setdefault("WIILINK_BROWSER_SAMPLE_INTERVAL", "0.1")
+    from browser import launch_profiles
+
+    browser_profiles = list(dict.fromkeys(args.browser_profile))
+    unknown = set(browser_profiles) - set(launch_profiles)
+    if unknown:
+        parser.error(f"unknown browser profiles: {', '.join(sorted(unknown))}")
+
+    server = StandInServer(
+        args.latency / 1000,
+        args.jitter / 1000,
+        args.error_rate,
+        args.pending_polls,
+        args.consoles,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    for service in ("sso", "accounts", "just_eat", "github"):
+        os.environ[f"WIILINK_{service.upper()}_URL"] = server.base_url
+
+    # Settings are kept with the cache, so a run never touches the user's own
+    cache_root = tempfile.TemporaryDirectory()
+    os.environ["WIILINK_CACHE_DIR"] = cache_root.name
+    os.environ["WIILINK_CONFIG_DIR"] = cache_root.name
+
+    app = QApplication(sys.argv[:1])
+    # Each finished wizard closes before the next one is shown, the run ends with quit()
+    app.setQuitOnLastWindowClosed(False)
+
+    dialog_timer = QTimer()
+    dialog_timer.timeout.connect(dismiss_modal_dialogs)
+    dialog_timer.start(50)
+
+    profiles = list(browser_profiles)
+    results = {profile: [] for profile in browser_profiles}
+    memory = {profile: [] for profile in browser_profiles}
+    # Finished wizards are kept alive, their startup threads may still be winding down
+    drivers = []
+
+    def run_next(finished_driver=None):
+        profile = os.environ.get("WIILINK_BROWSER_PROFILE")
+        if finished_driver is not None:
+            results[profile].append(finished_driver.stages)
+            if finished_driver.memory is not None:
+                memory[profile].append(finished_driver.memory)
+            total = finished_driver.stages["total"] * 1000
+            print(f"Iteration {len(results[profile])} ({profile}): {total:.0f} ms")
+            finished_driver.wizard.hide()
+
+        if finished_driver is None or len(results[profile]) == args.iterations:
+            if not profiles:
+                app.quit()
+                return
+            os.environ["WIILINK_BROWSER_PROFILE"] = profiles.pop(0)
+
+        if not args.warm_cache:
+            os.environ["WIILINK_CACHE_DIR"] = tempfile.mkdtemp(dir=cache_root.name)
+            os.environ["WIILINK_CONFIG_DIR"] = os.environ["WIILINK_CACHE_DIR"]
+
+        drivers.append(
+            WizardDriver(
+                app,
+                lambda done: QTimer.singleShot(0, lambda: run_next(done)),
+                args.link_all,
+            )
+        )
+
+    QTimer.singleShot(0, run_next)
+    app.exec()
+    server.shutdown()
+
+    summaries = {}
+    for profile in browser_profiles:
+        if len(browser_profiles) > 1:
+            print(f"\nBrowser profile: {profile}")
+        summaries[profile] = report(results[profile])
+        summaries[profile]["browser memory"] = report_memory(memory[profile])
+
+    if len(browser_profiles) > 1:
+        print()
+        compare(browser_profiles[0], summaries)
+
+    if args.output:
+        if len(browser_profiles) == 1:
+            output = summaries[browser_profiles[0]]
+        else:
+            output = summaries
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(output, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+import asyncio
+import atexit
+import base64
+import deadlines
+import fnmatch
+import json
+import os
+import runtime
+import supervisor
+import time
+import tracing
+import nodriver as uc
+
+# Used by the lean page load mode, see Blocklist
+default_blocked_resource_types = ["Image", "Font", "Media"]
+default_blocked_urls = [
+    "*://*.google-analytics.com/*",
+    "*://*.googletagmanager.com/*",
+    "*://*.doubleclick.net/*",
+    "*://*.facebook.net/*",
+    "*://*.facebook.com/tr*",
+    "*://*.hotjar.com/*",
+    "*://*.optimizely.com/*",
+    "*://*.segment.io/*",
+    "*://*.newrelic.com/*",
+    "*://*.nr-data.net/*",
+    "*://*.quantummetric.com/*",
+    "*://*.tiktok.com/*",
+    "*://*.snapchat.com/*",
+    "*://*.bing.com/*",
+]
+# Captchas don't work without their images, so these are never blocked
+default_allowed_urls = [
+    "*recaptcha*",
+    "*hcaptcha*",
+    "*arkoselabs*",
+    "*funcaptcha*",
+]
+
+# Persistent user data directories of the browsers running now. Chromium can't share
+# one between two browsers, a second browser gets a temporary one instead.
+_user_data_dirs_in_use: set[str] = set()
+
+# Chromium arguments per launch profile, picked with WIILINK_BROWSER_PROFILE. Every
+# profile sizes the window to match a phone screen and puts it in the top left corner.
+launch_profiles = {
+    "default": [],
+    # For thin clients with little memory. Only the login page is ever open, so one
+    # renderer process is enough, and it has no WebGL or video, so software compositing
+    # is too. Extensions, sync and the background services of a normal profile are off.
+    "lean": [
+        "--renderer-process-limit=1",
+        "--disable-gpu",
+        "--disable-extensions",
+        "--disable-component-extensions-with-background-pages",
+        "--disable-default-apps",
+        "--disable-background-networking",
+        "--disable-component-update",
+        "--disable-sync",
+        "--disable-breakpad",
+        "--disable-features=Translate,OptimizationHints,MediaRouter",
+        "--metrics-recording-only",
+    ],
+}
+
+
+async def launch_browser(
+    browser_path: str = None, user_data_dir: str = None
+) -> uc.Browser:
+    """Starts a browser and parks its first tab on about:blank. It keeps its cookies and
+    cache in `user_data_dir` if given, otherwise in a temporary profile.
+
+    Returns:
+        The started browser"""
+    if user_data_dir in _user_data_dirs_in_use:
+        print(f"Browser profile {user_data_dir} is in use, using a temporary one")
+        user_data_dir = None
+    if user_data_dir is not None:
+        _user_data_dirs_in_use.add(user_data_dir)
+
+    started = time.perf_counter()
+    try:
+        browser = await uc.start(
+            browser_executable_path=browser_path,
+            browser_args=launch_args(os.getenv("WIILINK_BROWSER_PROFILE", "default")),
+            user_data_dir=user_data_dir,
+        )
+    except BaseException:
+        _user_data_dirs_in_use.discard(user_data_dir)
+        raise
+    await browser.get("about:blank")
+    launch_time = time.perf_counter() - started
+
+    pid = browser_pid(browser)
+    if pid is not None:
+        supervisor.watch(pid, launch_time)
+
+    return browser
+
+
+def launch_args(profile: str) -> list[str]:
+    """Gets the Chromium arguments for a launch profile, see launch_profiles
+
+    Returns:
+        The arguments"""
+    if profile not in launch_profiles:
+        print(f"Unknown browser profile {profile}, using the default one")
+        profile = "default"
+
+    return ["--window-size=412,915", "--window-position=0,0"] + launch_profiles[profile]
+
+
+async def stop_browser(browser: uc.Browser):
+    """Stops a browser and waits for its whole process tree to be gone, killing any
+    process that doesn't exit by itself"""
+    # Read first, nodriver forgets the process when terminating it fails
+    pid = browser_pid(browser)
+    browser.stop()
+
+    if pid is not None:
+        await asyncio.to_thread(supervisor.release, pid)
+    _user_data_dirs_in_use.discard(browser.config.user_data_dir)
+
+
+def browser_pid(browser: uc.Browser) -> int:
+    """Gets the PID of a browser's main process
+
+    Returns:
+        The PID, or None if nodriver didn't start the process itself"""
+    process = getattr(browser, "_process", None)
+    return getattr(browser, "_process_pid", None) or getattr(process, "pid", None)
+
+
+class BrowserPrewarmer:
+    """Launches the browser early so the Just Eat login doesn't wait for a cold start.
+
+    nodriver ties a browser to the loop that started it, so the browser is launched on
+    the shared runtime loop, where the login that takes it runs too."""
+
+    def __init__(self, browser_path: str = None, user_data_dir: str = None):
+        self.browser_path = browser_path
+        self.user_data_dir = user_data_dir
+        self.taken = False
+        self.future = None
+
+    def start(self):
+        self.future = runtime.submit(
+            launch_browser(self.browser_path, self.user_data_dir)
+        )
+        atexit.register(self.discard)
+
+    async def take(self) -> uc.Browser:
+        """Waits for the pre-warmed browser to finish starting and hands it over
+
+        Returns:
+            The browser, or None if it failed to start"""
+        self.taken = True
+        try:
+            return await asyncio.wrap_future(self.future)
+        except Exception:
+            return None
+
+    def discard(self):
+        """Tears the browser down if the flow was abandoned before it was taken"""
+        if self.future is None or self.taken:
+            return
+
+        self.taken = True
+        try:
+            runtime.submit(self.shutdown()).result(deadlines.cancel_timeout)
+        except Exception:
+            pass
+
+    async def shutdown(self):
+        try:
+            browser = await asyncio.wrap_future(self.future)
+        except Exception:
+            return
+
+        await stop_browser(browser)
+
+
+class Blocklist:
+    """Requests the login page doesn't need, failed before they leave the browser.
+
+    Blocked requests are matched with CDP Fetch patterns, so only those cross into
+    Python. Blocked requests are counted per resource type for the session report.
+
+    A blocked request is never answered, so its size can't be known. In `measure` mode
+    nothing is blocked, the matching requests are let through and sized by their
+    Content-Length instead, to estimate what blocking saves."""
+
+    def __init__(
+        self,
+        resource_types: list[str],
+        urls: list[str],
+        allowed_urls: list[str] = None,
+        measure: bool = False,
+    ):
+        self.resource_types = resource_types
+        self.urls = urls
+        self.allowed_urls = allowed_urls or []
+        self.measure = measure
+        self.blocked = {}
+        # Bytes of the matching responses, and how many of them had no Content-Length
+        self.blocked_bytes = 0
+        self.unsized = 0
+
+    @classmethod
+    def from_environment(cls):
+        """Builds the blocklist for the lean page load mode
+
+        WIILINK_LEAN_PAGE_LOAD=1 turns the mode on, WIILINK_LEAN_PAGE_LOAD=measure
+        only measures what it would block. WIILINK_BLOCKLIST and
+        WIILINK_BLOCKED_RESOURCE_TYPES replace the default URL patterns and resource
+        types with comma separated lists.
+
+        Returns:
+            The configured blocklist, or None if the mode is off"""
+        mode = os.getenv("WIILINK_LEAN_PAGE_LOAD")
+        if mode not in ("1", "measure"):
+            return None
+
+        return cls(
+            env_list("WIILINK_BLOCKED_RESOURCE_TYPES", default_blocked_resource_types),
+            env_list("WIILINK_BLOCKLIST", default_blocked_urls),
+            default_allowed_urls,
+            measure=mode == "measure",
+        )
+
+    def patterns(self) -> list[uc.cdp.fetch.RequestPattern]:
+        # Measured requests are paused once their response headers are in
+        if self.measure:
+            stage = uc.cdp.fetch.RequestStage.RESPONSE
+        else:
+            stage = uc.cdp.fetch.RequestStage.REQUEST
+
+        patterns = [
+            uc.cdp.fetch.RequestPattern(
+                url_pattern="*",
+                resource_type=uc.cdp.network.ResourceType(resource_type),
+                request_stage=stage,
+            )
+            for resource_type in self.resource_types
+        ]
+        patterns.extend(
+            uc.cdp.fetch.RequestPattern(url_pattern=url, request_stage=stage)
+            for url in self.urls
+        )
+
+        return patterns
+
+    def is_allowed(self, url: str) -> bool:
+        return any(fnmatch.fnmatch(url, pattern) for pattern in self.allowed_urls)
+
+    def count(self, resource_type: str, size: int = None):
+        self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+        if size is None:
+            self.unsized += 1
+        else:
+            self.blocked_bytes += size
+
+    def summary(self, bytes_transferred: int) -> str:
+        blocked = ", ".join(
+            f"{resource_type}: {count}" for resource_type, count in self.blocked.items()
+        )
+        # Resource Timing reports 0 for cross origin resources without
+        # Timing-Allow-Origin, so the page's own total is a lower bound
+        if self.measure:
+            return (
+                f"Lean page load (measure): would block "
+                f"{sum(self.blocked.values())} requests ({blocked or 'none'}) saving "
+                f"{self.blocked_bytes} bytes, plus {self.unsized} without a "
+                f"Content-Length; the page downloaded at least "
+                f"{bytes_transferred} bytes"
+            )
+
+        return (
+            f"Lean page load: blocked {sum(self.blocked.values())} requests "
+            f"({blocked or 'none'}), the page downloaded at least "
+            f"{bytes_transferred} bytes; WIILINK_LEAN_PAGE_LOAD=measure estimates "
+            f"the bytes blocking saves"
+        )
+
+
+class TokenCapture:
+    """Opens the Just Eat login page in a browser and waits for the token response.
+
+    This has no Qt dependencies so it can be shared by the wizard and batch mode."""
+
+    page: uc.Tab
+    browser: uc.Browser
+    token_json: dict
+    # The body the page sent to the token URL, used to refresh the token later
+    token_request: str = None
+
+    def __init__(
+        self,
+        eater_url: str,
+        token_url: str,
+        browser_path: str = None,
+        browser: uc.Browser = None,
+        user_data_dir: str = None,
+    ):
+        self.eater_url = eater_url
+        self.token_url = token_url
+        self.browser_path = browser_path
+        self.browser = browser
+        self.user_data_dir = user_data_dir
+        self.blocklist = Blocklist.from_environment()
+        self.token_got = asyncio.Event()
+
+    async def run(self) -> dict:
+        """Waits for the user to login and returns the token JSON
+
+        A browser is started, with the persistent profile in `user_data_dir` if given,
+        unless a pre-warmed one was passed in. Every wait is bound by the current
+        deadline, and the browser is stopped however this ends, including being
+        cancelled or running out of time."""
+        try:
+            return await self.capture()
+        finally:
+            if self.browser is not None:
+                async with tracing.async_span("browser stop", "browser"):
+                    await stop_browser(self.browser)
+
+    async def capture(self) -> dict:
+        if self.browser is None:
+            # Not cut short by the deadline, a half started browser couldn't be stopped
+            async with tracing.async_span("browser launch", "browser"):
+                self.browser = await launch_browser(
+                    self.browser_path, self.user_data_dir
+                )
+        self.page = self.browser.main_tab
+
+        # Only have Chromium pause on the token response instead of reporting every
+        # response on the page. Fetch is marked as enabled up front, otherwise nodriver
+        # enables it without patterns when the handler is added and pauses everything.
+        self.page.enabled_domains.append(uc.cdp.fetch)
+        self.page.add_handler(uc.cdp.fetch.RequestPaused, self.handler)
+        patterns = [
+            uc.cdp.fetch.RequestPattern(
+                url_pattern=url_pattern(self.token_url),
+                request_stage=uc.cdp.fetch.RequestStage.RESPONSE,
+            )
+        ]
+        if self.blocklist is not None:
+            patterns.extend(self.blocklist.patterns())
+        await self.page.send(uc.cdp.fetch.enable(patterns=patterns))
+
+        # domain from api "checkoutUrl"
+        async with tracing.async_span("login page load", "browser", url=self.eater_url):
+            self.page = await deadlines.wait_for(self.browser.get(self.eater_url))
+
+        async with tracing.async_span("wait for login", "browser"):
+            await deadlines.wait_for(self.token_got.wait())
+        if self.blocklist is not None:
+            print(self.blocklist.summary(await self.bytes_transferred()))
+
+        return self.token_json
+
+    async def handler(self, evt: uc.cdp.fetch.RequestPaused):
+        if evt.response_status_code is None and evt.response_error_reason is None:
+            # Paused before being sent, so this matched the blocklist
+            await self.block(evt)
+            return
+        if (
+            self.blocklist is not None
+            and self.blocklist.measure
+            and evt.request.url != self.token_url
+        ):
+            await self.measure(evt)
+            return
+
+        body = None
+        try:
+            # domain from api "authenticationApiUrl"
+            if evt.request.url == self.token_url and evt.request.method != "OPTIONS":
+                async with tracing.async_span("token response body", "browser"):
+                    body, is_base64 = await self.page.send(
+                        uc.cdp.fetch.get_response_body(evt.request_id)
+                    )
+                if is_base64:
+                    body = base64.b64decode(body).decode()
+                self.token_request = evt.request.post_data
+        finally:
+            # The page hangs unless every paused request is let through
+            await self.page.send(uc.cdp.fetch.continue_request(evt.request_id))
+
+        if body:
+            self.token_json = json.loads(body)
+            self.token_got.set()
+
+            # Nothing else is needed from this page, stop all interception and reporting
+            await self.page.send(uc.cdp.fetch.disable())
+            await self.page.send(uc.cdp.network.disable())
+
+    async def block(self, evt: uc.cdp.fetch.RequestPaused):
+        if self.blocklist.is_allowed(evt.request.url):
+            await self.page.send(uc.cdp.fetch.continue_request(evt.request_id))
+            return
+
+        self.blocklist.count(evt.resource_type.value)
+        await self.page.send(
+            uc.cdp.fetch.fail_request(
+                evt.request_id, uc.cdp.network.ErrorReason.BLOCKED_BY_CLIENT
+            )
+        )
+
+    async def measure(self, evt: uc.cdp.fetch.RequestPaused):
+        """Sizes a response the blocklist matches, then lets it through"""
+        try:
+            if not self.blocklist.is_allowed(evt.request.url):
+                lengths = [
+                    header.value
+                    for header in evt.response_headers or []
+                    if header.name.lower() == "content-length"
+                ]
+                size = int(lengths[0]) if lengths and lengths[0].isdigit() else None
+                self.blocklist.count(evt.resource_type.value, size)
+        finally:
+            await self.page.send(uc.cdp.fetch.continue_request(evt.request_id))
+
+    async def bytes_transferred(self) -> int:
+        """Sums what the page downloaded according to the Resource Timing API
+
+        Cross origin resources without Timing-Allow-Origin report 0, so this is a
+        lower bound."""
+        try:
+            return int(
+                await self.page.evaluate(
+                    "performance.getEntriesByType('navigation')"
+                    ".concat(performance.getEntriesByType('resource'))"
+                    ".reduce((total, entry) => total + (entry.transferSize || 0), 0)"
+                )
+            )
+        except Exception:
+            return 0
+
+
+def env_list(name: str, default: list[str]) -> list[str]:
+    """Reads a comma separated list from the environment, or `default` if it's unset"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def url_pattern(url: str) -> str:
+    """Escapes a URL for use as a CDP Fetch pattern, where * and ? are wildcards"""
+    return url.replace("\\", "\\\\").replace("*", "\\*").replace("?", "\\?")
@@ -7,6 +7,7 @@ param(
 $buildProject = {
     Write-Host "Building Just Eat Linker..."
     pyside6-project build pyproject.toml
+    python build_assets.py
 
     $argsArray = $additional_args -split " "
 
@@ -16,7 +17,7 @@ $buildProject = {
 
 $cleanBuild = {
     Write-Host "Cleaning..."
-    Remove-Item -Recurse -Force JustEatLinker.exe, ./JustEatLinker.build/, ./JustEatLinker.dist/, ./JustEatLinker.onefile-build/
+    Remove-Item -Recurse -Force JustEatLinker.exe, ./JustEatLinker.build/, ./JustEatLinker.dist/, ./JustEatLinker.onefile-build/, ./build/resources/, resources.rcc
 }
 
 switch ($Task.ToLower()) {
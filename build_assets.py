@@ -0,0 +1,141 @@
+# Pre-renders the images the linker shows at the exact sizes it draws them and packs them into a compiled Qt
+# resource bundle (resources.rcc), together with the stylesheet with its asset paths already resolved. At runtime
+# the bundle is memory mapped, so launching doesn't have to decode the full size WebP files and scale them down
+# again, or read and rewrite style.qss. The compiled translation catalogues are embedded as well, along with Qt's own
+# qtbase catalogue for each language, so only the active language's catalogue is ever loaded.
+
+# Usage:
+# python build_assets.py
+# Run after "pyside6-project build", which compiles the .ts files into .qm catalogues.
+
+import pathlib
+import shutil
+import subprocess
+import sys
+
+from PySide6.QtCore import QLibraryInfo, QSize, Qt
+from PySide6.QtGui import QGuiApplication, QImage
+from resources import (
+    banner_size,
+    icon_sizes,
+    logo_size,
+    resolve_stylesheet,
+    resources_file,
+)
+
+RCC_CMD = "pyside6-rcc"
+
+assets_dir = pathlib.Path("assets")
+translations_dir = pathlib.Path("translations")
+build_dir = pathlib.Path("build", "resources")
+
+
+def render(source: pathlib.Path, size: tuple[int, int], target: pathlib.Path):
+    """Scales an image down to fit in `size` like QIcon.pixmap() does, and saves it as a PNG"""
+    image = QImage(source.as_posix())
+    if image.isNull():
+        sys.exit(f"Unable to read {source}")
+
+    box = QSize(*size)
+    if image.width() > box.width() or image.height() > box.height():
+        image = image.scaled(
+            box,
+            Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation,
+        )
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    image.save(target.as_posix(), "PNG")
+
+
+def main():
+    app = QGuiApplication(["build_assets", "-platform", "offscreen"])
+
+    if build_dir.exists():
+        shutil.rmtree(build_dir)
+
+    files = []
+    for size in icon_sizes:
+        target = build_dir.joinpath("icons", f"logo_{size}.png")
+        render(assets_dir.joinpath("logo.webp"), (size, size), target)
+        files.append(target)
+
+    target = build_dir.joinpath("images", "just_eat_logo.png")
+    render(assets_dir.joinpath("just_eat_logo.webp"), logo_size, target)
+    files.append(target)
+
+    target = build_dir.joinpath("images", "background.png")
+    render(assets_dir.joinpath("background.webp"), banner_size, target)
+    files.append(target)
+
+    for flag in sorted(assets_dir.joinpath("pride_banners").iterdir()):
+        target = build_dir.joinpath("images", "pride_banners", f"{flag.stem}.png")
+        render(flag, banner_size, target)
+        files.append(target)
+
+    # The stylesheet is stored already resolved, pointing at the icons in the bundle
+    for icon in sorted(assets_dir.glob("*.svg")):
+        target = build_dir.joinpath("assets", icon.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(icon, target)
+        files.append(target)
+
+    qt_translations_dir = pathlib.Path(
+        QLibraryInfo.path(QLibraryInfo.LibraryPath.TranslationsPath)
+    )
+    for catalogue in sorted(translations_dir.glob("translation_*.qm")):
+        target = build_dir.joinpath("translations", catalogue.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(catalogue, target)
+        files.append(target)
+
+        language = catalogue.stem.removeprefix("translation_")
+        qtbase = qt_translations_dir.joinpath(f"qtbase_{language}.qm")
+        if not qtbase.exists():
+            # e.g. es_ES has no catalogue of its own, es covers it
+            qtbase = qt_translations_dir.joinpath(f"qtbase_{language.split('_')[0]}.qm")
+        if qtbase.exists():
+            target = build_dir.joinpath("translations", f"qtbase_{language}.qm")
+            shutil.copyfile(qtbase, target)
+            files.append(target)
+
+    target = build_dir.joinpath("translations", "languages.json")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(translations_dir.joinpath("languages.json"), target)
+    files.append(target)
+
+    target = build_dir.joinpath("style.qss")
+    target.write_text(
+        resolve_stylesheet(
+            pathlib.Path("style.qss").read_text(encoding="utf-8"), ":/assets"
+        ),
+        encoding="utf-8",
+    )
+    files.append(target)
+
+    qrc_file = build_dir.joinpath("resources.qrc")
+    entries = "\n".join(
+        f"        <file>{file.relative_to(build_dir).as_posix()}</file>"
+        for file in files
+    )
+    qrc_file.write_text(
+        f"""<!DOCTYPE RCC>
+<RCC version="1.0">
+    <qresource prefix="/">
+{entries}
+    </qresource>
+</RCC>
+""",
+        encoding="utf-8",
+    )
+
+    # Stored uncompressed, PNGs are already compressed and this keeps the bundle mappable
+    subprocess.run(
+        [RCC_CMD, "--binary", "--no-compress", qrc_file, "-o", resources_file],
+        check=True,
+    )
+    print(f"Wrote {len(files)} files to {resources_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+
+# Default time budgets in seconds. Each can be overridden with WIILINK_<STAGE>_BUDGET,
+# e.g. WIILINK_BROWSER_LOGIN_BUDGET=300. A stage never gets more time than is left of
+# the stage it runs in, so everything is bounded by the flow budget.
+stage_budgets = {
+    "flow": 30 * 60,
+    "startup": 30,
+    "sso_login": 15 * 60,
+    "console_list": 30,
+    "login_urls": 30,
+    "browser_login": 10 * 60,
+    "link": 60,
+}
+
+# How long cancelling waits for tasks to release what they hold, long enough for the
+# supervisor to kill a browser that doesn't exit, see supervisor.exit_grace_period
+cancel_timeout = 10
+
+# Per socket operation, a request is additionally cut short by the current deadline
+connect_timeout = float(os.getenv("WIILINK_CONNECT_TIMEOUT", 5))
+read_timeout = float(os.getenv("WIILINK_READ_TIMEOUT", 30))
+
+# time.monotonic() value the current stage has to finish by, None for no deadline.
+# Being a context variable, asyncio tasks and asyncio.to_thread inherit it.
+_deadline: contextvars.ContextVar[float] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a stage or the whole flow runs out of time"""
+
+
+def stage_budget(stage: str) -> float:
+    return float(os.getenv(f"WIILINK_{stage.upper()}_BUDGET", stage_budgets[stage]))
+
+
+def deadline_for(stage: str) -> float:
+    """Works out when a stage started now has to finish, within the current deadline
+
+    Returns:
+        The deadline as a time.monotonic() value"""
+    deadline = time.monotonic() + stage_budget(stage)
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+
+    return deadline
+
+
+def start(stage: str):
+    """Applies a stage's budget to the rest of the current context, for the flow budget
+    on the GUI thread which has no enclosing block to scope it to"""
+    _deadline.set(deadline_for(stage))
+
+
+def current() -> float:
+    """Gets the current deadline, to hand it to another context with set_deadline
+
+    Returns:
+        The deadline as a time.monotonic() value, None for no deadline"""
+    return _deadline.get()
+
+
+def set_deadline(deadline: float):
+    """Adopts a deadline worked out in another context, e.g. by a task's creator"""
+    _deadline.set(deadline)
+
+
+@contextlib.contextmanager
+def budget(stage: str):
+    """Runs the body of a with block with a stage's budget"""
+    token = _deadline.set(deadline_for(stage))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float:
+    """Seconds left until the current deadline
+
+    Returns:
+        The seconds left, None if there is no deadline"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+def http_timeout() -> tuple[float, float]:
+    """Gets the connect and read timeouts for a request sent now
+
+    Returns:
+        The timeouts, in the form requests takes them"""
+    left = remaining()
+    if left is None:
+        return connect_timeout, read_timeout
+    if left <= 0:
+        raise DeadlineExceeded("Ran out of time before the request could be sent")
+
+    return min(connect_timeout, left), min(read_timeout, left)
+
+
+async def wait_for(awaitable):
+    """Awaits something until the current deadline, cancelling it if time runs out
+
+    Returns:
+        The awaitable's result"""
+    try:
+        return await asyncio.wait_for(awaitable, remaining())
+    except DeadlineExceeded:
+        raise
+    except TimeoutError as e:
+        raise DeadlineExceeded("Ran out of time waiting") from e
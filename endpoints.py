@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+import storage
+
+from urllib.parse import urlparse
+
+# Default base URL of every service the linker talks to. Each can be overridden with an
+# environment variable holding one or more comma separated candidates, e.g.
+# WIILINK_SSO_URL=http://127.0.0.1:8080 or
+# WIILINK_JUST_EAT_URL=https://eu.mirror.example,https://just-eat.wiilink.ca
+# or with an "endpoints" entry of the same shape in settings.json in the config
+# directory. Of several candidates, the fastest to answer at startup is used.
+services = {
+    "sso": "https://sso.riiconnect24.net",
+    "accounts": "https://accounts.wiilink.ca",
+    "just_eat": "https://just-eat.wiilink.ca",
+    "github": "https://api.github.com",
+}
+
+# How long a candidate gets to answer the startup probe before it counts as down
+probe_timeout = float(os.getenv("WIILINK_ENDPOINT_PROBE_TIMEOUT", 2))
+# Answers that mean the candidate can't serve requests. Anything else, a 404 or a 501
+# for HEAD too, shows the server is up.
+unhealthy_statuses = (502, 503, 504)
+
+# The candidate picked for each service by probe_all, and the probes still running
+_selected: dict[str, str] = {}
+_probing: dict[str, threading.Event] = {}
+_lock = threading.Lock()
+
+
+def candidates(service: str) -> list[str]:
+    """Gets every configured base URL of a service, in order of preference
+
+    Returns:
+        The base URLs, the environment taking precedence over settings.json"""
+    value = os.getenv(f"WIILINK_{service.upper()}_URL")
+    if value is None:
+        value = configured_endpoints().get(service, services[service])
+    if isinstance(value, str):
+        value = value.split(",")
+
+    urls = [url.strip().rstrip("/") for url in value if url.strip()]
+    return urls or [services[service]]
+
+
+@functools.cache
+def configured_endpoints() -> dict:
+    """Reads the endpoints entry of settings.json once, it's looked up for every request
+
+    Returns:
+        A dict of service to its base URLs"""
+    settings = storage.read_json(storage.settings_path(), {})
+    return settings.get("endpoints", {})
+
+
+def hosts() -> set[str]:
+    """Gets the host of every candidate of every service, one connection pool each
+
+    Returns:
+        The host names"""
+    return {urlparse(url).netloc for service in services for url in candidates(service)}
+
+
+def base_url(service: str) -> str:
+    """Gets the base URL to use for a service. While the startup probe is still
+    choosing between several candidates, background threads wait for it. The GUI
+    thread never does, it gets the first candidate until the probe is done.
+
+    Returns:
+        The probed candidate if there is one, otherwise the first candidate"""
+    with _lock:
+        probing = _probing.get(service)
+    if (
+        probing is not None
+        and threading.current_thread() is not threading.main_thread()
+    ):
+        probing.wait(probe_timeout + 1)
+
+    with _lock:
+        selected = _selected.get(service)
+    return selected or candidates(service)[0]
+
+
+def url(service: str, path: str) -> str:
+    """Builds the full URL of an endpoint
+
+    Returns:
+        The path appended to the service's base URL"""
+    return base_url(service) + path
+
+
+def measure_latency(base: str) -> float:
+    """Sends one request to a candidate, without retries so only one round trip is
+    timed
+
+    Returns:
+        The round trip in seconds, or None if the candidate is down"""
+    import http_client
+
+    started = time.perf_counter()
+    try:
+        response = http_client.request(
+            "HEAD",
+            base + "/",
+            retry=False,
+            timeout=probe_timeout,
+            allow_redirects=False,
+        )
+    except http_client.RequestException:
+        return None
+    if response.status_code in unhealthy_statuses:
+        return None
+
+    return time.perf_counter() - started
+
+
+async def probe(service: str) -> str:
+    """Probes every candidate of a service at once and picks the fastest healthy one.
+    The first candidate is kept if none of them answer.
+
+    Returns:
+        The chosen base URL"""
+    urls = candidates(service)
+    latencies = await asyncio.gather(
+        *(
+            asyncio.wait_for(asyncio.to_thread(measure_latency, url), probe_timeout)
+            for url in urls
+        ),
+        return_exceptions=True,
+    )
+
+    healthy = [
+        (latency, url)
+        for latency, url in zip(latencies, urls)
+        if isinstance(latency, float)
+    ]
+    chosen = min(healthy)[1] if healthy else urls[0]
+
+    measured = ", ".join(
+        (
+            f"{url} {latency * 1000:.0f} ms"
+            if isinstance(latency, float)
+            else f"{url} down"
+        )
+        for latency, url in zip(latencies, urls)
+    )
+    print(f"Endpoint {service}: using {chosen} ({measured})")
+
+    return chosen
+
+
+async def probe_all():
+    """Picks the lowest latency candidate of every service that has more than one.
+    Requests made meanwhile wait for their service's pick, see base_url."""
+    to_probe = [service for service in services if len(candidates(service)) > 1]
+    with _lock:
+        for service in to_probe:
+            _probing.setdefault(service, threading.Event())
+
+    async def probe_one(service: str):
+        try:
+            chosen = await probe(service)
+            with _lock:
+                _selected[service] = chosen
+        finally:
+            with _lock:
+                probing = _probing.pop(service, None)
+            if probing is not None:
+                probing.set()
+
+    await asyncio.gather(*(probe_one(service) for service in to_probe))
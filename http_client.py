@@ -0,0 +1,132 @@
+import threading
+import deadlines
+import endpoints
+import tracing
+
+from constants import linker_version
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+_session: "requests.Session" = None
+_adapter = None
+# For latency probes, which must time a single attempt, see endpoints.py
+_probe_session: "requests.Session" = None
+_session_lock = threading.Lock()
+
+
+def __getattr__(name: str):
+    # requests is only imported once the first request is made. Its exceptions are
+    # looked up lazily too, so `except http_client.HTTPError` doesn't import it early.
+    if name in ("HTTPError", "RequestException"):
+        import requests.exceptions
+
+        return getattr(requests.exceptions, name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_session() -> "requests.Session":
+    """Gets the session shared by every thread, creating it on first use
+
+    Returns:
+        The shared session"""
+    global _session, _adapter
+
+    with _session_lock:
+        if _session is None:
+            import requests
+
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            # Only idempotent methods are retried, POSTs like the token poll never are
+            retry_policy = Retry(
+                total=3,
+                backoff_factor=0.5,
+                backoff_jitter=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                raise_on_status=False,
+            )
+            # Every host the linker talks to, mirrors included, gets its own
+            # keep-alive connection pool
+            _adapter = HTTPAdapter(
+                pool_connections=len(endpoints.hosts()),
+                pool_maxsize=8,
+                max_retries=retry_policy,
+            )
+
+            _session = requests.Session()
+            _session.headers["User-Agent"] = f"WiiLink Just Eat Linker {linker_version}"
+            _session.mount("https://", _adapter)
+            _session.mount("http://", _adapter)
+
+        return _session
+
+
+def get_probe_session() -> "requests.Session":
+    """Gets the session shared by latency probes, which never retries
+
+    Returns:
+        The probe session"""
+    global _probe_session
+
+    with _session_lock:
+        if _probe_session is None:
+            import requests
+
+            _probe_session = requests.Session()
+            _probe_session.headers["User-Agent"] = (
+                f"WiiLink Just Eat Linker {linker_version}"
+            )
+
+        return _probe_session
+
+
+def request(method: str, url: str, retry: bool = True, **kwargs) -> "requests.Response":
+    # Never wait on a stalled socket past the current stage's deadline
+    kwargs.setdefault("timeout", deadlines.http_timeout())
+
+    session = get_session() if retry else get_probe_session()
+    with tracing.span(f"{method} {url}", "http") as trace_args:
+        response = session.request(method, url, **kwargs)
+        trace_args["status"] = response.status_code
+        # Retried requests show up as one span covering every attempt
+        retries = response.raw.retries
+        trace_args["retries"] = len(retries.history) if retries else 0
+
+    return response
+
+
+def get(url: str, **kwargs) -> "requests.Response":
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> "requests.Response":
+    return request("POST", url, **kwargs)
+
+
+def connection_stats() -> dict[str, dict]:
+    """Reports how many requests each host pool served and how many of them reused a kept-alive connection
+
+    Returns:
+        A dict of host to its request, connection and reuse counts"""
+    stats = {}
+    if _adapter is None:
+        return stats
+
+    pools = _adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+
+        stats[pool.host] = {
+            "requests": pool.num_requests,
+            "connections": pool.num_connections,
+            "reused": max(0, pool.num_requests - pool.num_connections),
+        }
+
+    return stats
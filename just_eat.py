@@ -1,12 +1,10 @@
 import asyncio
-import traceback
-import uuid
-import random
-import base64
-import json
 import time
-import requests
-import nodriver as uc
+import traceback
+import deadlines
+import http_client
+import token_store
+import tracing
 
 from PySide6.QtWidgets import (
     QWizardPage,
@@ -16,13 +14,58 @@ from PySide6.QtWidgets import (
     QComboBox,
     QMessageBox,
 )
-from PySide6.QtCore import QTimer, QObject, Signal, QThread
-from requests.exceptions import HTTPError
-from constants import devices, linker_version
+from PySide6.QtCore import QTimer, QObject, Signal
+from linking import (
+    browser_profile_dir,
+    get_login_urls,
+    link_consoles,
+    make_acr,
+    refresh_just_eat_token,
+    stored_token_key,
+    token_request_params,
+)
+from workers import BackgroundTask
 
 country = ""
 
 
+def link_token(
+    token: dict, wii_numbers: list[int], access_token: str, country: str
+) -> list[dict]:
+    """Links a Just Eat token to every given console
+
+    Returns:
+        The result for each console, see linking.link_consoles"""
+    device_id, acr = make_acr(country)
+    return link_consoles(token, wii_numbers, access_token, device_id, acr)
+
+
+def link_with_stored_token(
+    entry: dict,
+    token_url: str,
+    wii_numbers: list[int],
+    access_token: str,
+    country: str,
+) -> list[dict]:
+    """Links the consoles with a Just Eat token saved by token_store. The token is
+    posted as is while it's valid, otherwise it is refreshed first and `entry` updated.
+
+    Returns:
+        The result for each console, see linking.link_consoles"""
+    with tracing.span("stored token link", "just_eat"):
+        expires_in = entry["expires_at"] - time.time()
+        if expires_in < 60:
+            token = refresh_just_eat_token(
+                token_url, entry["request_params"], entry["token"]["refresh_token"]
+            )
+            entry["token"] = token
+            entry["expires_at"] = time.time() + int(token["expires_in"])
+        else:
+            token = {**entry["token"], "expires_in": int(expires_in)}
+
+        return link_token(token, wii_numbers, access_token, country)
+
+
 class CountrySelect(QWizardPage):
     countries = {
         "United Kingdom": "UK",
@@ -55,29 +98,9 @@ class CountrySelect(QWizardPage):
         country = self.countries[text]
 
 
-def link_to_server(data, wii_number, auth, device_id, acr):
-    header = {
-        "Authorization": auth,
-        "User-Agent": f"WiiLink Just Eat Linker {linker_version}",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-
-    payload = {
-        "wii_number": wii_number,
-        "eat_auth": "Bearer " + data["access_token"],
-        "refresh_token": data["refresh_token"],
-        "expire_time": int(time.time()) + int(data["expires_in"]),
-        "device_model": device_id,
-        "acr": acr,
-    }
-
-    return requests.post(
-        "https://just-eat.wiilink.ca/link", headers=header, data=payload
-    )
-
-
 class JustEatCredentialsPage(QWizardPage):
     login_complete = False
+    token_url: str
 
     # noinspection PyPackageRequirements
     def __init__(self, parent=None):
@@ -100,101 +123,227 @@ IMPORTANT - DO NOT RESIZE THE BROWSER WINDOW. DOING SO CAN CAUSE THE PROCESS TO
         self.layout.addWidget(instructions)
         self.setLayout(self.layout)
 
-        self.browser_thread = QThread()
         self.browser_worker = BrowserWorker()
-
+        self.login_urls_task: BackgroundTask = None
+        self.browser_task: BackgroundTask = None
+        self.stored_token_task: BackgroundTask = None
+        self.stored_token_entry: dict = None
+        self.link_task: BackgroundTask = None
+        self.token: dict = None
+
+    @tracing.traced("JustEatCredentialsPage.initializePage", "page")
     def initializePage(self):
         QTimer.singleShot(0, self.disable_back_button)
 
-        try:
-            resp = requests.get(
-                f"https://just-eat.wiilink.ca/loginurls.json?country={country}"
-            )
-            resp.raise_for_status()
-        except HTTPError:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
-            QMessageBox.critical(
-                self,
-                "WiiLink Just Eat Linker - Error",
-                f"""The linker was unable to get login information from WiiLink servers.
+        # Usually prefetched at startup, but fetched here if that failed or hasn't
+        # finished for this country yet
+        self.login_urls_task = BackgroundTask(
+            get_login_urls, country, stage="login_urls"
+        )
+        self.login_urls_task.finished.connect(self.login_urls_loaded)
+        self.login_urls_task.error.connect(self.login_urls_failed)
+        self.login_urls_task.start()
+
+    def login_urls_loaded(self, login_urls: dict):
+        tracing.handoff_received(self.login_urls_task.handoff)
+        self.token_url = login_urls["token_url"]
+        self.login_urls = login_urls
+        if self.start_stored_token_link():
+            return
 
-Received status code {resp.status_code}.
-Response: {resp.text}""",
-            )
+        self.start_browser_login()
+
+    def login_urls_failed(self, error: Exception):
+        tracing.handoff_received(self.login_urls_task.handoff)
+        if isinstance(error, asyncio.CancelledError):
             return
-        except:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
+
+        if isinstance(error, http_client.HTTPError):
             QMessageBox.critical(
                 self,
                 "WiiLink Just Eat Linker - Error",
                 f"""The linker was unable to get login information from WiiLink servers.
 
-{exception_traceback}""",
+Received status code {error.response.status_code}.
+Response: {error.response.text}""",
             )
             return
 
+        exception_traceback = "".join(traceback.format_exception(error))
+        QMessageBox.critical(
+            self,
+            "WiiLink Just Eat Linker - Error",
+            f"""The linker was unable to get login information from WiiLink servers.
+
+{exception_traceback}""",
+        )
+
+    def start_browser_login(self):
+        login_urls = self.login_urls
         self.browser_worker.browser_path = self.wizard().property("browser")
-        self.browser_worker.eater_url = resp.json()["eater_url"]
-        self.browser_worker.token_url = resp.json()["token_url"]
+        self.browser_worker.prewarmer = self.wizard().property("browser_prewarmer")
+        self.browser_worker.user_data_dir = browser_profile_dir(
+            self.wizard().property("access_token")
+        )
+        self.browser_worker.eater_url = login_urls["eater_url"]
+        self.browser_worker.token_url = login_urls["token_url"]
+
+        self.browser_task = BackgroundTask(
+            self.browser_worker.run_browser, stage="browser_login"
+        )
+        self.browser_task.finished.connect(self.browser_done)
+        self.browser_task.error.connect(self.browser_failed)
+        self.browser_task.start()
+
+    def start_stored_token_link(self) -> bool:
+        """Re-links in the background with the Just Eat token saved for this account and
+        country, so the browser doesn't have to be opened again. The browser login is
+        started if that fails.
+
+        Returns:
+            Whether there is a saved token, otherwise the browser login is needed"""
+        key = stored_token_key(self.wizard().property("access_token"), country)
+        entry = token_store.load(key) if key is not None else None
+        if entry is None:
+            return False
+
+        self.stored_token_entry = entry
+        self.stored_token_task = BackgroundTask(
+            link_with_stored_token,
+            entry,
+            self.token_url,
+            self.wizard().property("wii_nos"),
+            self.wizard().property("access_token"),
+            country,
+            stage="link",
+        )
+        self.stored_token_task.finished.connect(self.stored_token_linked)
+        self.stored_token_task.error.connect(self.stored_token_failed)
+        self.stored_token_task.start()
+
+        return True
+
+    def stored_token_linked(self, results: list[dict]):
+        tracing.handoff_received(self.stored_token_task.handoff)
+        if all(result["error"] is not None for result in results):
+            self.start_browser_login()
+            return
+
+        self.wizard().setProperty("link_results", results)
+        key = stored_token_key(self.wizard().property("access_token"), country)
+        token_store.save(key, self.stored_token_entry)
+        print("Linked with the stored Just Eat token, skipping the browser login")
+
+        prewarmer = self.wizard().property("browser_prewarmer")
+        if prewarmer is not None:
+            prewarmer.discard()
 
-        self.browser_worker.moveToThread(self.browser_thread)
-        self.browser_thread.started.connect(self.browser_worker.begin_browser)
-        self.browser_worker.token_signal.connect(self.browser_done)
-        self.browser_worker.token_signal.connect(self.browser_thread.quit)
-        self.browser_worker.token_signal.connect(self.browser_worker.deleteLater)
-        self.browser_worker.token_signal.connect(self.browser_thread.deleteLater)
+        self.login_complete = True
+        self.completeChanged.emit()
+        QTimer.singleShot(0, self.wizard().next)
+
+    def stored_token_failed(self, error: Exception):
+        tracing.handoff_received(self.stored_token_task.handoff)
+        if isinstance(error, asyncio.CancelledError):
+            return
 
-        self.browser_thread.start()
+        # The browser login is the fallback, and replaces the entry if it succeeds
+        self.start_browser_login()
+
+    def store_token(self, token: dict, token_request: str):
+        key = stored_token_key(self.wizard().property("access_token"), country)
+        if not token_store.available() or key is None or token_request is None:
+            return
+
+        token_store.save(
+            key,
+            {
+                "token": {
+                    "access_token": token["access_token"],
+                    "refresh_token": token["refresh_token"],
+                    "expires_in": token["expires_in"],
+                },
+                "expires_at": time.time() + int(token["expires_in"]),
+                "request_params": token_request_params(token_request),
+            },
+        )
 
     def browser_done(self, token: dict):
-        global country
+        tracing.handoff_received(self.browser_task.handoff)
+
+        # Every selected console is linked in the background, the page stays responsive
+        self.token = token
+        self.link_task = BackgroundTask(
+            link_token,
+            token,
+            self.wizard().property("wii_nos"),
+            self.wizard().property("access_token"),
+            country,
+            stage="link",
+        )
+        self.link_task.finished.connect(self.consoles_linked)
+        self.link_task.error.connect(self.link_failed)
+        self.link_task.start()
 
-        device_id = random.choice(devices)
-        acr_device = {
-            "DeviceType": "Android",
-            "DeviceName": device_id,
-            "DeviceId": str(uuid.uuid4()),
-        }
-        acr = f"tenant:{country} device:{base64.b64encode(json.dumps(acr_device).encode()).decode()} deviceId:{device_id}"
-
-        try:
-            resp = link_to_server(
-                token,
-                self.wizard().property("wii_no"),
-                self.wizard().property("access_token"),
-                device_id,
-                acr,
-            )
-            resp.raise_for_status()
-        except HTTPError:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
+    def consoles_linked(self, results: list[dict]):
+        tracing.handoff_received(self.link_task.handoff)
+        self.wizard().setProperty("link_results", results)
+
+        errors = [result["error"] for result in results if result["error"] is not None]
+        if len(errors) == len(results):
+            # Consoles that failed while others were linked are listed on FinalPage
             QMessageBox.critical(
                 self,
                 "WiiLink Just Eat Linker - Error",
                 f"""The linker was unable to link your Just Eat account to your WiiLink account.
 
-Received status code {resp.status_code}.
-Response: {resp.text}""",
+{errors[0]}""",
             )
             return
-        except:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
+
+        self.store_token(self.token, self.browser_worker.token_request)
+
+        self.login_complete = True
+        self.completeChanged.emit()
+        QTimer.singleShot(0, self.wizard().next)
+
+    def link_failed(self, error: Exception):
+        tracing.handoff_received(self.link_task.handoff)
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        exception_traceback = "".join(traceback.format_exception(error))
+        QMessageBox.critical(
+            self,
+            "WiiLink Just Eat Linker - Error",
+            f"""The linker was unable to link your Just Eat account to your WiiLink account.
+
+{exception_traceback}""",
+        )
+
+    def browser_failed(self, error: Exception):
+        tracing.handoff_received(self.browser_task.handoff)
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        if isinstance(error, deadlines.DeadlineExceeded):
             QMessageBox.critical(
                 self,
                 "WiiLink Just Eat Linker - Error",
-                f"""The linker was unable to link your Just Eat account to your WiiLink account.
-
-{exception_traceback}""",
+                self.tr(
+                    "The Just Eat login took too long and the browser was closed. Please restart the linker to try again."
+                ),
             )
             return
 
-        self.login_complete = True
-        self.completeChanged.emit()
-        QTimer.singleShot(0, self.wizard().next)
+        exception_traceback = "".join(traceback.format_exception(error))
+        QMessageBox.critical(
+            self,
+            "WiiLink Just Eat Linker - Error",
+            f"""The linker was unable to complete the Just Eat login in the browser.
+
+{exception_traceback}""",
+        )
 
     def disable_back_button(self):
         self.wizard().button(QWizard.WizardButton.BackButton).setEnabled(False)
@@ -207,41 +356,37 @@ Response: {resp.text}""",
 
 
 class BrowserWorker(QObject):
-    page: uc.Tab
-    browser: uc.Browser
-    token_json: dict
+    """Runs the Just Eat login in the browser on the shared asyncio runtime"""
+
     eater_url: str
     token_url: str
     browser_path: str = None
-    token_got = asyncio.Event()
+    # The account's persistent browser profile, see linking.browser_profile_dir
+    user_data_dir: str = None
+    # A browser.BrowserPrewarmer, browser and nodriver are only imported once needed
+    prewarmer = None
+    token_request: str = None
 
+    # Emitted from the runtime thread as soon as the token is captured
     token_signal = Signal(dict)
 
-    def begin_browser(self):
-        uc.loop().run_until_complete(self.run_browser())
+    async def run_browser(self) -> dict:
+        from browser import TokenCapture
 
-    async def run_browser(self):
-        self.browser = await uc.start(
-            browser_executable_path=self.browser_path,
-            # size to match phone screen, window position to put it always in the top left corner
-            browser_args=["--window-size=412,915", "--window-position=0,0"],
+        browser = None
+        if self.prewarmer is not None:
+            async with tracing.async_span("take pre-warmed browser", "browser"):
+                browser = await self.prewarmer.take()
+
+        capture = TokenCapture(
+            self.eater_url,
+            self.token_url,
+            self.browser_path,
+            browser,
+            self.user_data_dir,
         )
-        self.page = await self.browser.get("about:blank")
-        self.page.add_handler(uc.cdp.network.ResponseReceived, self.handler)
-
-        # domain from api "checkoutUrl"
-        self.page = await self.browser.get(self.eater_url)
-
-        await self.token_got.wait()
-        self.browser.stop()
-        self.token_signal.emit(self.token_json)
-
-    async def handler(self, evt: uc.cdp.network.ResponseReceived):
-        if evt.response.encoded_data_length > 0:
-            # domain from api "authenticationApiUrl"
-            if evt.response.url == self.token_url:
-                body, is_base64 = await self.page.send(
-                    uc.cdp.network.get_response_body(evt.request_id)
-                )
-                self.token_json = json.loads(body)
-                self.token_got.set()
+        token_json = await capture.run()
+        self.token_request = capture.token_request
+        self.token_signal.emit(token_json)
+
+        return token_json
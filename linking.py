@@ -0,0 +1,516 @@
+import asyncio
+import base64
+import contextvars
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import traceback
+import uuid
+import endpoints
+import http_client
+import storage
+import token_store
+
+from concurrent.futures import ThreadPoolExecutor
+from constants import devices, linker_version
+from urllib.parse import parse_qsl
+
+client_id = "ChGKaNcTcArxLCWSxAbvXXtbWKsM1xcy6x7k8ssn"
+user_agent = f"WiiLink Just Eat Linker {linker_version}"
+
+# How long cached login URLs are used before they are fetched again, in seconds
+login_urls_ttl = float(os.getenv("WIILINK_LOGIN_URLS_TTL", 24 * 60 * 60))
+_login_urls_lock = threading.Lock()
+
+# Console lists change rarely. An empty list is never cached, and the console page can
+# fetch the list again, so a console linked meanwhile shows up, see get_cached_linked_wiis
+linked_wiis_ttl = float(os.getenv("WIILINK_CONSOLE_LIST_TTL", 5 * 60))
+
+# token_store key of the WiiLink SSO refresh token. The credential store belongs to the OS
+# user, so on a shared machine every launch restores the same account until
+# forget_session is called, with --logout or from the console page.
+sso_session_key = "wiilink_sso"
+
+# Opt-in: keep a Chromium profile per WiiLink account, see browser_profile_dir
+persistent_browser_profiles = os.getenv("WIILINK_PERSISTENT_BROWSER_PROFILE") == "1"
+
+# Fields of the captured Just Eat token request that are the user's credentials, these
+# are never kept for refreshing the token
+credential_fields = {
+    "username",
+    "password",
+    "code",
+    "code_verifier",
+    "otp",
+    "grant_type",
+    "refresh_token",
+}
+
+
+def request_device_code() -> dict:
+    """Starts the WiiLink SSO device code flow
+
+    Returns:
+        The device authorization response, containing the device and user codes"""
+    scope = "openid email profile goauthentik.io/api"
+    if token_store.available():
+        # Only ask for a refresh token when there is somewhere safe to keep it
+        scope += " offline_access"
+
+    data = {
+        "client_id": client_id,
+        "scope": scope,
+    }
+
+    headers = {
+        "User-Agent": user_agent,
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+    resp = http_client.post(
+        endpoints.url("sso", "/application/o/device/"),
+        headers=headers,
+        data=data,
+    )
+    resp.raise_for_status()
+
+    return resp.json()
+
+
+def get_token(device_code: str) -> dict:
+    """Polls the WiiLink SSO token endpoint once for the given device code
+
+    Returns:
+        The token response, or the pending/error response from the server"""
+    data = {
+        "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
+        "client_id": client_id,
+        "device_code": device_code,
+    }
+
+    headers = {
+        "User-Agent": user_agent,
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+    resp = http_client.post(
+        endpoints.url("sso", "/application/o/token/"), headers=headers, data=data
+    )
+    if resp.status_code != 200 and resp.status_code != 400:
+        resp.raise_for_status()
+
+    return resp.json()
+
+
+def refresh_session(refresh_token: str) -> dict:
+    """Logs in to WiiLink SSO again with a refresh token from an earlier login
+
+    Returns:
+        The token response, with a new access token and possibly a new refresh token"""
+    data = {
+        "grant_type": "refresh_token",
+        "client_id": client_id,
+        "refresh_token": refresh_token,
+    }
+
+    headers = {
+        "User-Agent": user_agent,
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+    resp = http_client.post(
+        endpoints.url("sso", "/application/o/token/"), headers=headers, data=data
+    )
+    resp.raise_for_status()
+
+    return resp.json()
+
+
+def save_session(token: dict):
+    """Keeps the SSO refresh token from a token response for the next launch"""
+    if "refresh_token" in token:
+        token_store.save(sso_session_key, {"refresh_token": token["refresh_token"]})
+
+
+def forget_session():
+    """Deletes the saved SSO session, the next launch asks for a login again"""
+    token_store.delete(sso_session_key)
+
+
+def restore_session() -> dict:
+    """Refreshes the SSO session saved by an earlier launch
+
+    Returns:
+        The token response, or None if no session was saved"""
+    entry = token_store.load(sso_session_key)
+    if entry is None:
+        return None
+
+    try:
+        token = refresh_session(entry["refresh_token"])
+    except http_client.HTTPError as e:
+        if e.response.status_code == 400:
+            # invalid_grant, the session was revoked or expired
+            token_store.delete(sso_session_key)
+        raise
+
+    save_session(token)
+    return token
+
+
+class DeviceCodeError(Exception):
+    """Raised when a device code login ends without a token.
+
+    `error` is the RFC 8628 error code, e.g. access_denied or expired_token."""
+
+    def __init__(self, error: str, description: str = None):
+        super().__init__(description or error)
+        self.error = error
+
+
+class DeviceCodePoller:
+    """Polls the SSO token endpoint for a device code following RFC 8628.
+
+    Waits `interval` seconds between polls, adds 5 seconds on slow_down, gives up once
+    the code's `expires_in` has passed and stops on access_denied or expired_token.
+    Cancelling the task running `poll()` stops it immediately, even mid-wait."""
+
+    def __init__(self, device_code: str, interval: int, expires_in: int):
+        self.device_code = device_code
+        self.interval = interval
+        self.expires_in = expires_in
+
+        # Statistics for tuning server load against login latency
+        self.polls = 0
+        self.slow_downs = 0
+        self.authorized_after: float = None
+
+    async def poll(self) -> dict:
+        """Waits until the user authorizes the device
+
+        Returns:
+            The token response"""
+        started = time.monotonic()
+        deadline = started + self.expires_in
+        interval = self.interval
+
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() >= deadline:
+                raise DeviceCodeError("expired_token")
+
+            self.polls += 1
+            try:
+                data = await asyncio.to_thread(get_token, self.device_code)
+            except http_client.RequestException:
+                # A dropped connection isn't fatal, try again on the next tick
+                continue
+
+            error = data.get("error")
+            if error is None:
+                self.authorized_after = time.monotonic() - started
+                return data
+            elif error == "authorization_pending":
+                continue
+            elif error == "slow_down":
+                self.slow_downs += 1
+                interval += 5
+            else:
+                raise DeviceCodeError(error, data.get("error_description"))
+
+    def summary(self) -> str:
+        return (
+            f"SSO login authorized after {self.authorized_after:.1f}s, "
+            f"{self.polls} polls ({self.slow_downs} slow downs)"
+        )
+
+
+def get_linked_wiis(access_token: str) -> list[dict]:
+    """Gets the consoles linked to a WiiLink account
+
+    Returns:
+        A list of the linked Wiis, empty if the account has none"""
+    headers = {
+        "Authorization": access_token,
+    }
+
+    resp = http_client.get(endpoints.url("accounts", "/link/user"), headers=headers)
+    resp.raise_for_status()
+
+    attributes = resp.json()["attributes"]
+    if len(attributes) == 0:
+        return []
+
+    return attributes["wiis"]
+
+
+def get_cached_linked_wiis(access_token: str, refresh: bool = False) -> list[dict]:
+    """Gets the consoles linked to a WiiLink account, from the on-disk cache while the
+    account's entry is younger than linked_wiis_ttl, unless `refresh` is set. An empty
+    list isn't cached, the user is asked to link a console and try again.
+
+    Returns:
+        A list of the linked Wiis, empty if the account has none"""
+    account = account_id(access_token)
+    if account is None:
+        return get_linked_wiis(access_token)
+
+    cache_path = storage.cache_dir().joinpath("linked_wiis.json")
+    entry = storage.read_json(cache_path, {}).get(account)
+    if (
+        not refresh
+        and entry is not None
+        and time.time() - entry["fetched_at"] < linked_wiis_ttl
+    ):
+        return entry["wiis"]
+
+    wiis = get_linked_wiis(access_token)
+
+    cache = storage.read_json(cache_path, {})
+    if wiis:
+        cache[account] = {"wiis": wiis, "fetched_at": time.time()}
+    else:
+        cache.pop(account, None)
+    storage.write_json(cache_path, cache)
+
+    return wiis
+
+
+def account_id(access_token: str) -> str:
+    """Reads the account's subject from a WiiLink SSO access token, without verifying it
+
+    Returns:
+        The subject, or None if the token isn't a JWT"""
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))["sub"]
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def format_wii_number(wii_number) -> str:
+    """Formats a Wii number the way it is shown on the console, e.g. 0123-4567-8901-2345"""
+    wii_no_str = f"{int(wii_number):016}"
+    return f"{wii_no_str[:4]}-{wii_no_str[4:8]}-{wii_no_str[8:12]}-{wii_no_str[12:]}"
+
+
+def fetch_login_urls(country: str) -> dict:
+    """Fetches the Just Eat login and token URLs for a country from WiiLink servers
+
+    Returns:
+        A dict with the "eater_url" and "token_url" keys"""
+    resp = http_client.get(
+        endpoints.url("just_eat", "/loginurls.json"), params={"country": country}
+    )
+    resp.raise_for_status()
+
+    return resp.json()
+
+
+def get_login_urls(country: str) -> dict:
+    """Gets the Just Eat login and token URLs for a country
+
+    Served from the on-disk cache while the entry is younger than login_urls_ttl. If
+    the servers can't be reached an outdated entry is used rather than failing.
+
+    Returns:
+        A dict with the "eater_url" and "token_url" keys"""
+    cache_path = storage.cache_dir().joinpath("login_urls.json")
+    with _login_urls_lock:
+        entry = storage.read_json(cache_path, {}).get(country)
+
+    if entry is not None and time.time() - entry["fetched_at"] < login_urls_ttl:
+        return entry["urls"]
+
+    try:
+        urls = fetch_login_urls(country)
+    except http_client.RequestException:
+        if entry is not None:
+            return entry["urls"]
+        raise
+
+    with _login_urls_lock:
+        cache = storage.read_json(cache_path, {})
+        cache[country] = {"urls": urls, "fetched_at": time.time()}
+        storage.write_json(cache_path, cache)
+
+    return urls
+
+
+def prefetch_login_urls(countries: list[str]):
+    """Fills the login URL cache for every country in parallel, skipping fresh entries"""
+    with ThreadPoolExecutor(max_workers=len(countries)) as executor:
+        # Each fetch runs in a copy of this context, so it keeps the caller's deadline
+        futures = [
+            executor.submit(contextvars.copy_context().run, get_login_urls, country)
+            for country in countries
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # The credentials page retries and reports the error for its country
+                print(traceback.format_exc())
+
+
+def make_acr(country: str) -> tuple[str, str]:
+    """Generates a random Android device identity for a Just Eat login
+
+    Returns:
+        The device model and the acr value sent to the link server"""
+    device_id = random.choice(devices)
+    acr_device = {
+        "DeviceType": "Android",
+        "DeviceName": device_id,
+        "DeviceId": str(uuid.uuid4()),
+    }
+    acr = f"tenant:{country} device:{base64.b64encode(json.dumps(acr_device).encode()).decode()} deviceId:{device_id}"
+
+    return device_id, acr
+
+
+def stored_token_key(access_token: str, country: str) -> str:
+    """Gets the token_store key for a WiiLink account's Just Eat token in a country
+
+    Returns:
+        The key, or None if the account can't be identified"""
+    subject = account_id(access_token)
+    if subject is None:
+        return None
+
+    return f"just_eat:{subject}:{country}"
+
+
+def browser_profile_dir(access_token: str) -> str:
+    """Gets the Chromium user data directory kept for a WiiLink account, so Just Eat's
+    cookies and cached assets survive from one link to the next. Every account has its
+    own, only readable by the current user.
+
+    Returns:
+        The directory, or None if persistent profiles are off or the account can't be
+        identified"""
+    if not persistent_browser_profiles:
+        return None
+
+    subject = account_id(access_token)
+    if subject is None:
+        return None
+
+    name = hashlib.sha256(subject.encode()).hexdigest()[:16]
+    path = storage.cache_dir().joinpath("browser_profiles", name)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    return str(path)
+
+
+def token_request_params(post_data: str) -> dict:
+    """Keeps what's needed to refresh a token from the body of the token request the
+    browser sent, like the client ID, dropping the user's credentials
+
+    Returns:
+        The body format, "json" or "form", and the remaining fields"""
+    if post_data.lstrip().startswith("{"):
+        body_format = "json"
+        fields = json.loads(post_data)
+    else:
+        body_format = "form"
+        fields = dict(parse_qsl(post_data))
+
+    return {
+        "format": body_format,
+        "fields": {
+            name: value
+            for name, value in fields.items()
+            if name not in credential_fields
+        },
+    }
+
+
+def refresh_just_eat_token(
+    token_url: str, request_params: dict, refresh_token: str
+) -> dict:
+    """Exchanges a Just Eat refresh token for a new token, the way the login page would
+
+    Returns:
+        The token JSON, in the same form the browser login captures"""
+    fields = {
+        **request_params["fields"],
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+    }
+    headers = {"User-Agent": user_agent}
+
+    if request_params["format"] == "json":
+        resp = http_client.post(token_url, headers=headers, json=fields)
+    else:
+        resp = http_client.post(token_url, headers=headers, data=fields)
+    resp.raise_for_status()
+
+    token = resp.json()
+    # Refresh tokens aren't always rotated
+    token.setdefault("refresh_token", refresh_token)
+
+    return token
+
+
+def link_consoles(
+    data: dict, wii_numbers: list[int], auth: str, device_id: str, acr: str
+) -> list[dict]:
+    """Links one Just Eat token to several consoles, with the requests sent in parallel
+
+    Returns:
+        For each Wii number, a dict with the "wii_number" and an "error", which is None
+        if the console was linked"""
+
+    def link(wii_number: int) -> str:
+        try:
+            resp = link_to_server(data, wii_number, auth, device_id, acr)
+            resp.raise_for_status()
+        except http_client.HTTPError as e:
+            print(traceback.format_exc())
+            return f"""Received status code {e.response.status_code}.
+Response: {e.response.text}"""
+        except Exception:
+            exception_traceback = traceback.format_exc()
+            print(exception_traceback)
+            return exception_traceback
+
+        return None
+
+    # Matches the size of the connection pool, so no request waits for a connection
+    with ThreadPoolExecutor(max_workers=min(len(wii_numbers), 8)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, link, wii_number)
+            for wii_number in wii_numbers
+        ]
+        errors = [future.result() for future in futures]
+
+    return [
+        {"wii_number": wii_number, "error": error}
+        for wii_number, error in zip(wii_numbers, errors)
+    ]
+
+
+def link_to_server(data, wii_number, auth, device_id, acr):
+    header = {
+        "Authorization": auth,
+        "User-Agent": user_agent,
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+    payload = {
+        "wii_number": wii_number,
+        "eat_auth": "Bearer " + data["access_token"],
+        "refresh_token": data["refresh_token"],
+        "expire_time": int(time.time()) + int(data["expires_in"]),
+        "device_model": device_id,
+        "acr": acr,
+    }
+
+    return http_client.post(
+        endpoints.url("just_eat", "/link"), headers=header, data=payload
+    )
@@ -1,75 +1,64 @@
-import json
-import time
+import asyncio
 import sys
 import traceback
-import requests
-
-from constants import linker_version
+import deadlines
+import http_client
+import tracing
+
+from linking import (
+    DeviceCodeError,
+    DeviceCodePoller,
+    forget_session,
+    format_wii_number,
+    get_cached_linked_wiis,
+    save_session,
+)
 from PySide6.QtWidgets import (
     QWizardPage,
     QLabel,
     QVBoxLayout,
     QWizard,
-    QComboBox,
+    QListView,
     QMessageBox,
+    QPushButton,
 )
-from PySide6.QtCore import QThread, QObject, Signal, QTimer, Qt
-from requests.exceptions import HTTPError
+from PySide6.QtCore import QAbstractListModel, QModelIndex, QTimer, Qt
+from workers import BackgroundTask
 
 access_token = ""
 
 
-def get_token(device_code: str):
-    data = {
-        "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
-        "client_id": "ChGKaNcTcArxLCWSxAbvXXtbWKsM1xcy6x7k8ssn",
-        "device_code": device_code,
-    }
+async def wait_for_login(poller: DeviceCodePoller) -> dict:
+    """Polls until the device code is authorized, and keeps the session for next launch
 
-    headers = {
-        "User-Agent": f"WiiLink Just Eat Linker {linker_version}",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
+    Returns:
+        The token response"""
+    data = await deadlines.wait_for(poller.poll())
+    print(poller.summary())
+    await asyncio.to_thread(save_session, data)
 
-    resp = requests.post(
-        "https://sso.riiconnect24.net/application/o/token/", headers=headers, data=data
-    )
-    if resp.status_code != 200 and resp.status_code != 400:
-        resp.raise_for_status()
-
-    return resp.json()
+    return data
 
 
 class WiiLinkAccountPage(QWizardPage):
     interval: int
-    device_code: str
+    expires_in: int
+    device_code: str = None
     finished = False
+    initialized = False
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        # Get the device code
-        data = self.get_verification_url()
-
-        self.interval = data["interval"]
-        self.device_code = data["device_code"]
-
         self.setTitle(self.tr("Login to your WiiLink Account"))
         self.setSubTitle(self.tr("Login with your browser"))
 
-        self.link = QLabel(
-            self.tr(
-                "Visit <a href='{}?code={}'>{}</a> and enter the code below:</br></br>"
-            ).format(
-                data["verification_uri"], data["user_code"], data["verification_uri"]
-            )
-        )
+        # The device code is requested in the background at startup, see set_device_data
+        self.link = QLabel(self.tr("Requesting a login code from WiiLink..."))
         self.link.setWordWrap(True)
         self.link.setOpenExternalLinks(True)
 
-        self.code = QLabel(
-            f"<h1 style='text-align: center;'>{data["user_code"]}</h1></br></br>"
-        )
+        self.code = QLabel()
         self.code.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
 
         self.success = QLabel(
@@ -82,147 +71,315 @@ class WiiLinkAccountPage(QWizardPage):
         self.layout.addWidget(self.success)
         self.setLayout(self.layout)
 
-        self.logic_thread = QThread()
-        self.logic_worker = AccountConnector()
+        self.login_task: BackgroundTask = None
+
+    def set_device_data(self, data: dict):
+        self.interval = data["interval"]
+        self.expires_in = data["expires_in"]
+        self.device_code = data["device_code"]
+
+        self.link.setText(
+            self.tr(
+                "Visit <a href='{}?code={}'>{}</a> and enter the code below:</br></br>"
+            ).format(
+                data["verification_uri"], data["user_code"], data["verification_uri"]
+            )
+        )
+        self.code.setText(
+            f"<h1 style='text-align: center;'>{data["user_code"]}</h1></br></br>"
+        )
+
+        if self.initialized:
+            self.start_polling()
 
+    def set_session(self, data: dict):
+        """Logs in with the session restored from an earlier launch, no device code needed"""
+        global access_token
+        access_token = data["access_token"]
+
+        self.finished = True
+        self.wizard().setProperty("access_token", access_token)
+        self.wizard().setProperty("session_restored", True)
+        if self.initialized:
+            # Next was pressed before the session was restored
+            self.completeChanged.emit()
+            QTimer.singleShot(0, self.wizard().next)
+
+    def device_data_failed(self, error: Exception):
+        if isinstance(error, http_client.HTTPError):
+            QMessageBox.critical(
+                self,
+                "WiiLink Just Eat Linker - Error",
+                f"""The linker was unable to connect to WiiLink servers.
+
+Received status code {error.response.status_code}.
+Message: {error.response.text}""",
+            )
+        else:
+            exception_traceback = "".join(traceback.format_exception(error))
+            QMessageBox.critical(
+                self,
+                "WiiLink Just Eat Linker - Error",
+                f"""The linker was unable to connect to WiiLink servers.
+
+{exception_traceback}""",
+            )
+        sys.exit(1)
+
+    @tracing.traced("WiiLinkAccountPage.initializePage", "page")
     def initializePage(self):
         QTimer.singleShot(0, self.disable_back_button)
         QTimer.singleShot(0, self.disable_next_button)
 
-        self.logic_worker.interval = self.interval
-        self.logic_worker.device_code = self.device_code
+        self.initialized = True
+        if self.device_code is not None:
+            self.start_polling()
 
-        self.logic_worker.moveToThread(self.logic_thread)
-        self.logic_thread.started.connect(self.logic_worker.poll_device_page)
-
-        self.logic_worker.finished.connect(self.logic_finished)
-        self.logic_worker.finished.connect(self.logic_thread.quit)
-        self.logic_thread.finished.connect(self.logic_worker.deleteLater)
-        self.logic_thread.finished.connect(self.logic_thread.deleteLater)
+    def start_polling(self):
+        if self.login_task is not None:
+            return
 
-        self.logic_thread.start()
+        poller = DeviceCodePoller(self.device_code, self.interval, self.expires_in)
+        self.login_task = BackgroundTask(wait_for_login, poller, stage="sso_login")
+        self.login_task.finished.connect(self.logic_finished)
+        self.login_task.error.connect(self.logic_failed)
+        self.login_task.start()
 
     def isComplete(self):
         return self.finished
 
-    def logic_finished(self):
+    def logic_finished(self, data: dict):
+        tracing.handoff_received(self.login_task.handoff)
+
+        global access_token
+        access_token = data["access_token"]
+
         self.finished = True
         self.completeChanged.emit()
         self.wizard().setProperty("access_token", access_token)
         QTimer.singleShot(0, self.wizard().next)
 
+    def logic_failed(self, error: Exception):
+        tracing.handoff_received(self.login_task.handoff)
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        if isinstance(error, DeviceCodeError):
+            error = error.error
+        else:
+            error = "".join(traceback.format_exception(error))
+
+        match error:
+            case "access_denied":
+                message = self.tr("The login request was denied.")
+            case "expired_token":
+                message = self.tr(
+                    "The login code has expired. Please restart the linker to get a new one."
+                )
+            case _:
+                message = self.tr(
+                    "The linker was unable to log in to your WiiLink account.\n\n{}"
+                ).format(error)
+
+        QMessageBox.critical(self, "WiiLink Just Eat Linker - Error", message)
+        sys.exit(1)
+
     def disable_back_button(self):
         self.wizard().button(QWizard.WizardButton.BackButton).setEnabled(False)
 
     def disable_next_button(self):
         self.wizard().button(QWizard.WizardButton.NextButton).setEnabled(False)
 
-    def get_verification_url(self):
-        data = {
-            "client_id": "ChGKaNcTcArxLCWSxAbvXXtbWKsM1xcy6x7k8ssn",
-            "scope": "openid email profile goauthentik.io/api",
-        }
-
-        headers = {
-            "User-Agent": f"WiiLink Just Eat Linker {linker_version}",
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
-
-        try:
-            resp = requests.post(
-                "https://sso.riiconnect24.net/application/o/device/",
-                headers=headers,
-                data=data,
-            )
-            resp.raise_for_status()
-        except HTTPError:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
-            QMessageBox.critical(
-                self,
-                "WiiLink Just Eat Linker - Error",
-                f"""The linker was unable to connect to WiiLink servers.
-
-Received status code {resp.status_code}.
-Message: {resp.text}""",
-            )
-            sys.exit(1)
-        except:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
-            QMessageBox.critical(
-                self,
-                "WiiLink Just Eat Linker - Error",
-                f"""The linker was unable to connect to WiiLink servers.
 
-{exception_traceback}""",
-            )
-            sys.exit(1)
+class ConsoleListModel(QAbstractListModel):
+    """The consoles linked to the WiiLink account, each formatted once when loaded.
 
-        return resp.json()
-
-
-class AccountConnector(QObject):
-    finished = Signal(bool)
-    error = Signal(str)
-    device_code: str
-    interval: int
+    Every console has a checkbox, the checked ones are linked. The first console is
+    checked to begin with."""
 
-    def poll_device_page(self):
-        while True:
-            data = get_token(self.device_code)
-            try:
-                if data["error"] == "authorization_pending":
-                    time.sleep(self.interval)
-            except KeyError:
-                # If this happens we are logged in.
-                global access_token
-                access_token = data["access_token"]
-                break
+    WiiNumberRole = Qt.ItemDataRole.UserRole + 1
 
-        self.finished.emit(True)
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.consoles: list[tuple[int, str]] = []
+        self.checked: set[int] = set()
+
+    def set_consoles(self, wiis: list[dict]):
+        self.beginResetModel()
+        self.consoles = [
+            (int(wii["wii_number"]), format_wii_number(wii["wii_number"]))
+            for wii in wiis
+        ]
+        self.checked = {0} if self.consoles else set()
+        self.endResetModel()
+
+    def checked_wii_numbers(self) -> list[int]:
+        return [self.consoles[row][0] for row in sorted(self.checked)]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.consoles)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+
+        wii_number, wii_no_fancy = self.consoles[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return wii_no_fancy
+        elif role == Qt.ItemDataRole.CheckStateRole:
+            if index.row() in self.checked:
+                return Qt.CheckState.Checked
+            return Qt.CheckState.Unchecked
+        elif role == self.WiiNumberRole:
+            return wii_number
+
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or role != Qt.ItemDataRole.CheckStateRole:
+            return False
+
+        if Qt.CheckState(value) == Qt.CheckState.Checked:
+            self.checked.add(index.row())
+        else:
+            self.checked.discard(index.row())
+
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+
+        return (
+            Qt.ItemFlag.ItemIsEnabled
+            | Qt.ItemFlag.ItemIsSelectable
+            | Qt.ItemFlag.ItemIsUserCheckable
+        )
 
 
 class WiiNumberSelector(QWizardPage):
-    linked: bool = True
-    wii_no_dict = {}
+    loaded: bool = False
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setTitle(self.tr("Select your Wii Number"))
         self.setSubTitle(
-            self.tr("Select the Wii number you want to link with Just Eat.")
+            self.tr("Select the Wii numbers you want to link with Just Eat.")
         )
 
+        # The widgets are built once, initializePage only fills the model
+        self.status = QLabel(self.tr("Loading your linked consoles..."))
+        self.status.setTextFormat(Qt.TextFormat.RichText)
+        self.status.setWordWrap(True)
+        self.status.setOpenExternalLinks(True)
+
+        self.model = ConsoleListModel(self)
+        self.model.dataChanged.connect(self.selection_changed)
+        self.list = QListView()
+        # Every row is one line of text, so the view doesn't have to measure each one
+        self.list.setUniformItemSizes(True)
+        self.list.setModel(self.model)
+        self.list.hide()
+
+        # Fetches the list again, bypassing the cache, e.g. after linking a console
+        self.refresh_button = QPushButton(self.tr("Refresh"))
+        self.refresh_button.clicked.connect(lambda: self.load_consoles(refresh=True))
+        self.refresh_button.setEnabled(False)
+
+        # Only shown for a restored session, to sign out of it on a shared machine
+        self.sign_out_button = QPushButton(self.tr("Use a different account"))
+        self.sign_out_button.clicked.connect(self.sign_out)
+        self.sign_out_button.hide()
+
         self.layout = QVBoxLayout()
+        self.layout.addWidget(self.status)
+        self.layout.addWidget(self.list)
+        self.layout.addWidget(self.refresh_button)
+        self.layout.addWidget(self.sign_out_button)
+        self.setLayout(self.layout)
+
+        self.task: BackgroundTask = None
 
+    @tracing.traced("WiiNumberSelector.initializePage", "page")
     def initializePage(self):
         QTimer.singleShot(0, self.disable_back_button)
 
+        if self.task is not None:
+            return
+
+        if self.wizard().property("session_restored"):
+            self.sign_out_button.show()
+
+        self.load_consoles()
+
+    def load_consoles(self, refresh: bool = False):
         global access_token
 
-        this_headers = {
-            "Authorization": access_token,
-        }
+        self.loaded = False
+        self.refresh_button.setEnabled(False)
+        self.status.setText(self.tr("Loading your linked consoles..."))
+        self.status.show()
+        self.list.hide()
+        self.completeChanged.emit()
 
-        try:
-            resp = requests.get(
-                "https://accounts.wiilink.ca/link/user", headers=this_headers
+        self.task = BackgroundTask(
+            get_cached_linked_wiis, access_token, refresh, stage="console_list"
+        )
+        self.task.finished.connect(self.consoles_loaded)
+        self.task.error.connect(self.consoles_failed)
+        self.task.start()
+
+    def sign_out(self):
+        forget_session()
+        QMessageBox.information(
+            self,
+            "WiiLink Just Eat Linker",
+            self.tr(
+                "You have been signed out of this WiiLink account. Please restart the linker to log in with a different account."
+            ),
+        )
+        self.wizard().reject()
+
+    def consoles_loaded(self, wiis: list[dict]):
+        tracing.handoff_received(self.task.handoff)
+        self.model.set_consoles(wiis)
+        self.loaded = True
+        self.refresh_button.setEnabled(True)
+
+        if len(wiis) == 0:
+            self.status.setText(
+                self.tr("""Currently, you have no Wiis linked to your account.<br><br>
+
+Follow the guide at <a href='https://wiilink.ca/guide/accounts'>https://wiilink.ca/guide/accounts</a> to link your console.<br><br>
+
+Then, run this app again.""")
             )
-            resp.raise_for_status()
-        except HTTPError:
+        else:
+            self.status.hide()
+            self.list.show()
+
+        self.selection_changed()
+
+    def consoles_failed(self, error: Exception):
+        tracing.handoff_received(self.task.handoff)
+        if isinstance(error, asyncio.CancelledError):
+            return
+
+        self.refresh_button.setEnabled(True)
+        if isinstance(error, http_client.HTTPError):
             QMessageBox.critical(
                 self,
                 "WiiLink Just Eat Linker - Error",
                 f"""The linker was unable to get your linked consoles.
 
-Received status code {resp.status_code}.
-Message: {resp.text}""",
+Received status code {error.response.status_code}.
+Message: {error.response.text}""",
             )
-            return
-        except:
-            exception_traceback = traceback.format_exc()
-            print(exception_traceback)
+        else:
+            exception_traceback = "".join(traceback.format_exception(error))
             QMessageBox.critical(
                 self,
                 "WiiLink Just Eat Linker - Error",
@@ -230,52 +387,17 @@ Message: {resp.text}""",
 
 {exception_traceback}""",
             )
-            return
-
-        resp = resp.json()
-        if len(resp["attributes"]) == 0 or len(resp["attributes"]["wiis"]) == 0:
-            self.linked = False
-            label = QLabel(
-                self.tr("""Currently, you have no Wiis linked to your account.<br><br>
-
-Follow the guide at <a href='https://wiilink.ca/guide/accounts'>https://wiilink.ca/guide/accounts</a> to link your console.<br><br>
-
-Then, run this app again.""")
-            )
-            label.setTextFormat(Qt.TextFormat.RichText)
-            label.setWordWrap(True)
-            label.setOpenExternalLinks(True)
-            self.layout.addWidget(label)
-            self.setLayout(self.layout)
-            return
-
-        wiis = resp["attributes"]["wiis"]
-        for wii in wiis:
-            wii_no_str = "{:016}".format(int(wii["wii_number"]))
-            wii_no_str = "{}-{}-{}-{}".format(
-                wii_no_str[:4], wii_no_str[4:8], wii_no_str[8:12], wii_no_str[12:16]
-            )
-            self.wii_no_dict.update({wii_no_str: wii["wii_number"]})
-
-        box = QComboBox()
-        box.addItems(self.wii_no_dict.keys())
-        box.currentTextChanged.connect(self.number_changed)
-        self.wizard().setProperty("wii_no", wiis[0]["wii_number"])
-        self.wizard().setProperty("wii_no_fancy", box.currentText())
-
-        self.layout.addWidget(box)
-        self.setLayout(self.layout)
 
     def isComplete(self):
         # Needed to keep back button disabled when navigating back to page
         # Thank you Qt, this is very logical
         QTimer.singleShot(0, self.disable_back_button)
 
-        return self.linked
+        return self.loaded and len(self.model.checked) > 0
 
-    def number_changed(self, number):
-        self.wizard().setProperty("wii_no", self.wii_no_dict[number])
-        self.wizard().setProperty("wii_no_fancy", number)
+    def selection_changed(self):
+        self.wizard().setProperty("wii_nos", self.model.checked_wii_numbers())
+        self.completeChanged.emit()
 
     def disable_back_button(self):
         self.wizard().button(QWizard.WizardButton.BackButton).setEnabled(False)
@@ -0,0 +1,66 @@
+import contextlib
+import functools
+import inspect
+import json
+import time
+import tracing
+
+# Seconds spent in each named startup phase, in the order they first ran
+phases: dict[str, float] = {}
+
+
+def record(name: str, seconds: float):
+    phases[name] = phases.get(name, 0) + seconds
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Times the body of a with block and adds it to the named phase"""
+    start = time.perf_counter()
+    try:
+        with tracing.span(name, "startup"):
+            yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name: str, function):
+    """Wraps a function so every call to it is added to the named phase"""
+    if inspect.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            # Coroutines interleave on the runtime loop, so this can't be a span
+            start = time.perf_counter()
+            try:
+                async with tracing.async_span(name, "startup"):
+                    return await function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def report() -> str:
+    lines = ["Startup profile:"]
+    for name, seconds in phases.items():
+        lines.append(f"  {name:<24}{seconds * 1000:>10.1f} ms")
+
+    return "\n".join(lines)
+
+
+def dump(path: str):
+    """Writes the phases to a JSON file in milliseconds, for comparing builds"""
+    with open(path, "w", encoding="utf-8") as profile_file:
+        json.dump(
+            {name: seconds * 1000 for name, seconds in phases.items()},
+            profile_file,
+            indent=2,
+        )
@@ -0,0 +1,57 @@
+import os
+import time
+import endpoints
+import http_client
+import storage
+
+release_api_path = "/repos/WiiLink24/JustEatLinker/releases/latest"
+
+# How long a cached release check is trusted before GitHub is asked again, in seconds
+cache_ttl = float(os.getenv("WIILINK_UPDATE_CHECK_TTL", 6 * 60 * 60))
+
+
+def get_latest_version() -> str:
+    """Gets the tag of the latest stable release from the GitHub API
+
+    The result is cached on disk. Within the TTL no request is made at all, after it
+    a conditional request with the cached ETag is sent, which GitHub does not count
+    against the rate limit when the release hasn't changed.
+
+    Returns:
+        The latest tag from the GitHub API"""
+    cache_path = storage.cache_dir().joinpath("latest_release.json")
+    cache = storage.read_json(cache_path, {})
+    now = time.time()
+
+    if "tag_name" in cache and now - cache.get("checked_at", 0) < cache_ttl:
+        return cache["tag_name"]
+
+    headers = {}
+    if "tag_name" in cache and cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+
+    try:
+        api_response_raw = http_client.get(
+            endpoints.url("github", release_api_path), headers=headers
+        )
+        if api_response_raw.status_code != 304:
+            api_response_raw.raise_for_status()
+    except http_client.RequestException:
+        # Rate limited or offline, an outdated answer is better than none
+        if "tag_name" in cache:
+            return cache["tag_name"]
+        raise
+
+    if api_response_raw.status_code == 304:
+        cache["checked_at"] = now
+    else:
+        api_response = api_response_raw.json()
+        cache = {
+            "tag_name": api_response["tag_name"].replace("v", ""),
+            "etag": api_response_raw.headers.get("ETag"),
+            "checked_at": now,
+        }
+
+    storage.write_json(cache_path, cache)
+
+    return cache["tag_name"]
@@ -0,0 +1,133 @@
+import datetime
+import json
+import random
+
+from constants import file_path
+from PySide6.QtCore import QDir, QFile, QIODevice, QResource
+from PySide6.QtGui import QIcon, QPixmap
+
+# The sizes the wizard draws each image at, build_assets.py pre-renders them
+banner_size = (700, 120)
+logo_size = (64, 64)
+icon_sizes = [16, 32, 64, 256]
+
+resources_file = file_path.joinpath("resources.rcc")
+
+_registered: bool = None
+
+
+def register() -> bool:
+    """Memory maps the compiled resource bundle made by build_assets.py, if it exists
+
+    Returns:
+        Whether the pre-rendered images are available"""
+    global _registered
+
+    if _registered is None:
+        _registered = resources_file.exists() and QResource.registerResource(
+            resources_file.resolve().as_posix()
+        )
+
+    return _registered
+
+
+def window_icon() -> QIcon:
+    if register():
+        icon = QIcon()
+        for size in icon_sizes:
+            icon.addFile(f":/icons/logo_{size}.png")
+        return icon
+
+    return QIcon(file_path.joinpath("assets", "logo.webp").resolve().as_posix())
+
+
+def just_eat_logo() -> QPixmap:
+    if register():
+        return QPixmap(":/images/just_eat_logo.png")
+
+    just_eat_icon = QIcon(
+        file_path.joinpath("assets", "just_eat_logo.webp").resolve().as_posix()
+    )
+    return just_eat_icon.pixmap(*logo_size)
+
+
+def banner() -> QPixmap:
+    """Gets the wizard banner, a random pride flag in June"""
+    pride_month = datetime.datetime.now().month == 6
+
+    if register():
+        if pride_month:
+            flags_list = QDir(":/images/pride_banners").entryList()
+            return QPixmap(f":/images/pride_banners/{random.choice(flags_list)}")
+        return QPixmap(":/images/background.png")
+
+    if pride_month:
+        flags_list = list(file_path.joinpath("assets", "pride_banners").iterdir())
+        background = QIcon(random.choice(flags_list).resolve().as_posix())
+    else:
+        background = QIcon(
+            file_path.joinpath("assets", "background.webp").resolve().as_posix()
+        )
+    return background.pixmap(*banner_size)
+
+
+def translations_dir() -> str:
+    """Gets the directory holding the compiled .qm catalogues, inside the bundle when
+    build_assets.py has embedded them"""
+    if register():
+        return ":/translations"
+
+    return file_path.joinpath("translations").resolve().as_posix()
+
+
+def available_languages() -> list[str]:
+    """Lists the languages the linker can be shown in, without parsing languages.json
+
+    Returns:
+        Locale names with a compiled catalogue, plus English which the source is in"""
+    catalogues = QDir(translations_dir()).entryList(["translation_*.qm"])
+    return ["en"] + [
+        name.removeprefix("translation_").removesuffix(".qm") for name in catalogues
+    ]
+
+
+def language_names() -> dict[str, str]:
+    """Reads languages.json, only needed when the language selector is shown
+
+    Returns:
+        A dict of each language's name in that language to its locale name"""
+    if register():
+        names_file = QFile(":/translations/languages.json")
+        if names_file.open(QIODevice.OpenModeFlag.ReadOnly):
+            names = json.loads(bytes(names_file.readAll()).decode("utf-8"))
+            names_file.close()
+            return names
+
+    return json.loads(
+        file_path.joinpath("translations", "languages.json").read_text(encoding="utf-8")
+    )
+
+
+def resolve_stylesheet(stylesheet: str, assets_dir: str) -> str:
+    return stylesheet.replace("%AssetsDir%", assets_dir)
+
+
+def stylesheet() -> str:
+    """Gets the app stylesheet with its asset paths filled in
+
+    build_assets.py resolves it ahead of time into the bundle. Otherwise style.qss is
+    resolved when it's read, the app only does that once.
+
+    Returns:
+        The resolved stylesheet"""
+    if register():
+        style_file = QFile(":/style.qss")
+        if style_file.open(QIODevice.OpenModeFlag.ReadOnly):
+            resolved = bytes(style_file.readAll()).decode("utf-8")
+            style_file.close()
+            return resolved
+
+    return resolve_stylesheet(
+        file_path.joinpath("style.qss").read_text(encoding="utf-8"),
+        file_path.joinpath("assets").resolve().as_posix(),
+    )
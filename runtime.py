@@ -0,0 +1,36 @@
+import asyncio
+import concurrent.futures
+import threading
+
+# The one asyncio event loop every background coroutine runs on, browser automation,
+# device code polling and blocking network calls through asyncio.to_thread alike. It
+# lives on a daemon thread that is started on first use and kept until the app exits.
+_loop: asyncio.AbstractEventLoop = None
+_thread: threading.Thread = None
+_lock = threading.Lock()
+
+
+def loop() -> asyncio.AbstractEventLoop:
+    """Gets the runtime's event loop, starting its thread on first use
+
+    Returns:
+        The running event loop"""
+    global _loop, _thread
+
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(
+                target=_loop.run_forever, name="asyncio-runtime", daemon=True
+            )
+            _thread.start()
+
+        return _loop
+
+
+def submit(coroutine) -> concurrent.futures.Future:
+    """Schedules a coroutine on the runtime from any thread
+
+    Returns:
+        A future for its result, cancelling it cancels the coroutine"""
+    return asyncio.run_coroutine_threadsafe(coroutine, loop())
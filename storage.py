@@ -0,0 +1,86 @@
+import json
+import os
+import pathlib
+import shutil
+import sys
+
+
+def cache_dir() -> pathlib.Path:
+    """Gets the per-user cache directory for the linker, creating it if needed
+
+    Returns:
+        The cache directory, WIILINK_CACHE_DIR overrides where it is"""
+    if os.getenv("WIILINK_CACHE_DIR"):
+        path = pathlib.Path(os.getenv("WIILINK_CACHE_DIR"))
+    elif sys.platform == "win32":
+        base = os.getenv("LOCALAPPDATA") or pathlib.Path.home().joinpath(
+            "AppData", "Local"
+        )
+        path = pathlib.Path(base).joinpath("WiiLink", "JustEatLinker", "Cache")
+    elif sys.platform == "darwin":
+        path = pathlib.Path.home().joinpath(
+            "Library", "Caches", "WiiLink", "JustEatLinker"
+        )
+    else:
+        base = os.getenv("XDG_CACHE_HOME") or pathlib.Path.home().joinpath(".cache")
+        path = pathlib.Path(base).joinpath("WiiLink", "JustEatLinker")
+
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def config_dir() -> pathlib.Path:
+    """Gets the per-user directory for the linker's settings, creating it if needed.
+    Unlike the cache directory, OS cleanup tools leave it alone.
+
+    Returns:
+        The config directory, WIILINK_CONFIG_DIR overrides where it is"""
+    if os.getenv("WIILINK_CONFIG_DIR"):
+        path = pathlib.Path(os.getenv("WIILINK_CONFIG_DIR"))
+    elif sys.platform == "win32":
+        base = os.getenv("APPDATA") or pathlib.Path.home().joinpath(
+            "AppData", "Roaming"
+        )
+        path = pathlib.Path(base).joinpath("WiiLink", "JustEatLinker")
+    elif sys.platform == "darwin":
+        path = pathlib.Path.home().joinpath(
+            "Library", "Application Support", "WiiLink", "JustEatLinker"
+        )
+    else:
+        base = os.getenv("XDG_CONFIG_HOME") or pathlib.Path.home().joinpath(".config")
+        path = pathlib.Path(base).joinpath("WiiLink", "JustEatLinker")
+
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def settings_path() -> pathlib.Path:
+    """Gets the path of settings.json in the config directory. Older versions kept it in
+    the cache directory, it is moved over the first time.
+
+    Returns:
+        The path, the file may not exist yet"""
+    path = config_dir().joinpath("settings.json")
+    old_path = cache_dir().joinpath("settings.json")
+    if not path.exists() and old_path.exists():
+        try:
+            shutil.move(old_path, path)
+        except OSError:
+            pass
+
+    return path
+
+
+def read_json(path: pathlib.Path, default=None):
+    """Reads a JSON file, returning `default` if it is missing or unreadable"""
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path: pathlib.Path, data):
+    """Atomically replaces a JSON file so a crash never leaves a half written cache"""
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(json.dumps(data), encoding="utf-8")
+    os.replace(temp_path, path)
@@ -0,0 +1,265 @@
+import atexit
+import os
+import signal
+import threading
+import time
+import storage
+
+# How often a browser's process tree is sampled for new processes and memory use
+sample_interval = float(os.getenv("WIILINK_BROWSER_SAMPLE_INTERVAL", 1))
+# How long the processes of a stopped browser get to exit before they are killed
+exit_grace_period = 3
+
+_supervisors: dict[int, "BrowserSupervisor"] = {}
+# Every browser supervised in this run, stopped ones too, for the benchmark
+sessions: list["BrowserSupervisor"] = []
+_lock = threading.Lock()
+
+
+def _psutil():
+    # psutil is optional, without it only the main browser process can be cleaned up
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    return psutil
+
+
+class BrowserSupervisor:
+    """Tracks the whole process tree of one browser so none of it outlives the session.
+
+    Chromium's renderer, GPU and utility processes are found by sampling the tree on a
+    background thread, which also records the session's peak memory use. The processes
+    are written to a file in the cache directory while they run, so any left behind by
+    a hard crash are cleaned up on the next launch by reap_leaked_browsers."""
+
+    def __init__(self, pid: int, launch_time: float = None):
+        self.pid = pid
+        self.launch_time = launch_time
+        self.started = time.monotonic()
+        self.processes = {}
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self.stopped = threading.Event()
+
+        psutil = _psutil()
+        self.root = None
+        if psutil is not None:
+            try:
+                self.root = psutil.Process(pid)
+            except psutil.Error:
+                pass
+
+        self.thread = threading.Thread(
+            target=self.sample_loop, name=f"browser-supervisor-{pid}", daemon=True
+        )
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def sample_loop(self):
+        while not self.stopped.wait(sample_interval):
+            self.sample()
+
+    def sample(self):
+        if self.root is None:
+            return
+
+        psutil = _psutil()
+        try:
+            tree = [self.root] + self.root.children(recursive=True)
+        except psutil.Error:
+            # The main process is gone, its children are still known from earlier
+            return
+
+        rss = 0
+        new_processes = False
+        for process in tree:
+            if process.pid not in self.processes:
+                self.processes[process.pid] = process
+                new_processes = True
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_processes = max(self.peak_processes, len(tree))
+        if new_processes:
+            _save_running()
+
+    def kill(self, grace_period: float = 0) -> int:
+        """Stops every process of the tree still running, killing those that don't exit
+        within `grace_period` seconds
+
+        Returns:
+            How many processes were still running"""
+        self.stopped.set()
+
+        psutil = _psutil()
+        if self.root is None:
+            # Without psutil only the main process is known. Once it was asked to exit
+            # its PID isn't signalled, it may already belong to another process.
+            if grace_period > 0:
+                return 0
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                return 0
+            return 1
+
+        alive = [
+            process for process in list(self.processes.values()) if process.is_running()
+        ]
+        if grace_period > 0:
+            _gone, alive = psutil.wait_procs(alive, timeout=grace_period)
+
+        for process in alive:
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        _gone, still_alive = psutil.wait_procs(alive, timeout=exit_grace_period)
+        for process in still_alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+        return len(alive)
+
+    def report(self, leaked: int) -> str:
+        duration = time.monotonic() - self.started
+        launch = ""
+        if self.launch_time is not None:
+            launch = f" (launched in {self.launch_time:.2f}s)"
+        if self.root is None:
+            return (
+                f"Browser session: {duration:.1f}s{launch} "
+                f"(install psutil for memory use)"
+            )
+
+        return (
+            f"Browser session: {duration:.1f}s{launch}, "
+            f"peak RSS {self.peak_rss / 2**20:.1f} MB "
+            f"across {self.peak_processes} processes, "
+            f"{leaked} left behind and killed"
+        )
+
+
+def watch(pid: int, launch_time: float = None) -> BrowserSupervisor:
+    """Starts supervising the browser whose main process is `pid`, which took
+    `launch_time` seconds to start
+
+    Returns:
+        The supervisor"""
+    browser_supervisor = BrowserSupervisor(pid, launch_time)
+    with _lock:
+        _supervisors[pid] = browser_supervisor
+        sessions.append(browser_supervisor)
+    browser_supervisor.start()
+    _save_running()
+
+    return browser_supervisor
+
+
+def release(pid: int):
+    """Makes sure a browser that was asked to stop is gone, and prints its session
+    report. Blocks for up to a few seconds."""
+    with _lock:
+        browser_supervisor = _supervisors.pop(pid, None)
+    if browser_supervisor is None:
+        return
+
+    # Give the browser the chance to exit by itself before anything is killed
+    leaked = browser_supervisor.kill(grace_period=exit_grace_period)
+    print(browser_supervisor.report(leaked))
+    _save_running()
+
+
+def kill_all():
+    """Kills every supervised browser, for when the linker is exiting"""
+    with _lock:
+        supervisors = list(_supervisors.values())
+        _supervisors.clear()
+
+    for browser_supervisor in supervisors:
+        browser_supervisor.kill()
+    _save_running()
+
+
+def install_signal_handlers():
+    """Kills the supervised browsers when the linker is terminated by a signal, which
+    skips atexit. Must be called from the main thread."""
+
+    def handle(signum, _frame):
+        kill_all()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    for name in ("SIGTERM", "SIGHUP"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handle)
+
+
+def _running_path():
+    # One file per linker process, so runs side by side never reap each other's browsers
+    return storage.cache_dir().joinpath(f"browser_processes_{os.getpid()}.json")
+
+
+def _save_running():
+    with _lock:
+        running = [
+            {"pid": process.pid, "create_time": process.create_time()}
+            for browser_supervisor in _supervisors.values()
+            for process in list(browser_supervisor.processes.values())
+            if process.is_running()
+        ]
+
+    if running:
+        storage.write_json(_running_path(), running)
+    else:
+        _running_path().unlink(missing_ok=True)
+
+
+def reap_leaked_browsers() -> int:
+    """Kills browser processes an earlier run left behind because it crashed or was
+    killed outright. Needs psutil, a process start time has to match before anything
+    is killed, so a reused PID is never touched.
+
+    Returns:
+        How many processes were killed"""
+    psutil = _psutil()
+    if psutil is None:
+        return 0
+
+    leaked = []
+    for path in storage.cache_dir().glob("browser_processes_*.json"):
+        owner = int(path.stem.rpartition("_")[2])
+        if owner != os.getpid() and psutil.pid_exists(owner):
+            # That linker is still running and looks after its own browsers
+            continue
+
+        for record in storage.read_json(path, []):
+            try:
+                process = psutil.Process(record["pid"])
+                if process.create_time() == record["create_time"]:
+                    leaked.append(process)
+            except psutil.Error:
+                pass
+        path.unlink(missing_ok=True)
+
+    for process in leaked:
+        try:
+            process.kill()
+        except psutil.Error:
+            pass
+
+    if leaked:
+        print(f"Killed {len(leaked)} browser processes left behind by an earlier run")
+    return len(leaked)
+
+
+atexit.register(kill_all)
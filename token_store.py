@@ -0,0 +1,70 @@
+import json
+import os
+
+# Opt-in with WIILINK_TOKEN_STORE=1. Tokens are kept in the operating system's
+# credential store (Windows Credential Locker, macOS Keychain, Secret Service) through
+# the optional keyring package, nothing is written to disk by the linker itself.
+enabled = os.getenv("WIILINK_TOKEN_STORE") == "1"
+service_name = "WiiLink Just Eat Linker"
+
+
+def _keyring():
+    if not enabled:
+        return None
+
+    try:
+        import keyring
+    except ImportError:
+        return None
+
+    return keyring
+
+
+def available() -> bool:
+    return _keyring() is not None
+
+
+def load(key: str) -> dict:
+    """Reads an entry from the credential store
+
+    Returns:
+        The stored entry, or None if there is none or the store is unavailable"""
+    keyring = _keyring()
+    if keyring is None:
+        return None
+
+    try:
+        value = keyring.get_password(service_name, key)
+    except Exception:
+        # A locked or missing keychain backend behaves like an empty store
+        return None
+
+    if value is None:
+        return None
+
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+def save(key: str, entry: dict):
+    keyring = _keyring()
+    if keyring is None:
+        return
+
+    try:
+        keyring.set_password(service_name, key, json.dumps(entry))
+    except Exception as e:
+        print(f"Unable to save to the credential store: {e}")
+
+
+def delete(key: str):
+    keyring = _keyring()
+    if keyring is None:
+        return
+
+    try:
+        keyring.delete_password(service_name, key)
+    except Exception:
+        pass
@@ -0,0 +1,186 @@
+import atexit
+import contextlib
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+# Opt-in: WIILINK_TRACE=trace.json records spans for HTTP calls, page initialization,
+# browser phases and Qt signal handoffs, and writes them in the Chrome trace event
+# format on exit. Load the file in chrome://tracing or https://ui.perfetto.dev.
+trace_path = os.getenv("WIILINK_TRACE")
+enabled = bool(trace_path)
+
+_events = []
+_thread_names = {}
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_origin = time.perf_counter()
+
+
+def _now() -> float:
+    """Microseconds since the trace started, the unit Chrome traces use"""
+    return (time.perf_counter() - _origin) * 1_000_000
+
+
+def _add(event: dict):
+    thread = threading.current_thread()
+    event["pid"] = os.getpid()
+    event["tid"] = thread.ident
+    with _lock:
+        _thread_names[thread.ident] = thread.name
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = "app", **args):
+    """Records the body of a with block as a slice on the current thread
+
+    Yields:
+        The span's args, which the body may add to, e.g. a response status code"""
+    if not enabled:
+        yield args
+        return
+
+    start = _now()
+    try:
+        yield args
+    finally:
+        _add(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": _now() - start,
+                "args": args,
+            }
+        )
+
+
+@contextlib.asynccontextmanager
+async def async_span(name: str, category: str = "app", **args):
+    """Like span, for coroutines that interleave with others on the same event loop"""
+    if not enabled:
+        yield args
+        return
+
+    span_id = next(_ids)
+    _add({"name": name, "cat": category, "ph": "b", "id": span_id, "ts": _now()})
+    try:
+        yield args
+    finally:
+        _add(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "e",
+                "id": span_id,
+                "ts": _now(),
+                "args": args,
+            }
+        )
+
+
+def traced(name: str = None, category: str = "app"):
+    """Decorator recording every call to a function as a span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__qualname__, category):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instant(name: str, category: str = "app", **args):
+    if enabled:
+        _add(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "i",
+                "s": "t",
+                "ts": _now(),
+                "args": args,
+            }
+        )
+
+
+def handoff(name: str) -> dict:
+    """Marks a signal being emitted towards another thread
+
+    Returns:
+        A token to pass to handoff_received on the receiving side"""
+    if not enabled:
+        return None
+
+    flow = {"name": name, "id": next(_ids), "ts": _now()}
+    _add(
+        {
+            "name": f"{name} emit",
+            "cat": "signal",
+            "ph": "X",
+            "ts": flow["ts"],
+            "dur": 1,
+        }
+    )
+    _add({"name": name, "cat": "signal", "ph": "s", "id": flow["id"], "ts": flow["ts"]})
+
+    return flow
+
+
+def handoff_received(flow: dict):
+    """Marks a queued signal arriving, linked to where it was emitted"""
+    if not enabled or flow is None:
+        return
+
+    received = _now()
+    _add(
+        {
+            "name": f"{flow['name']} received",
+            "cat": "signal",
+            "ph": "X",
+            "ts": received,
+            "dur": 1,
+            "args": {"queued_us": received - flow["ts"]},
+        }
+    )
+    _add(
+        {
+            "name": flow["name"],
+            "cat": "signal",
+            "ph": "f",
+            "bp": "e",
+            "id": flow["id"],
+            "ts": received,
+        }
+    )
+
+
+def write(path: str):
+    with _lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+
+    metadata = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": thread_name},
+        }
+        for tid, thread_name in thread_names.items()
+    ]
+    with open(path, "w", encoding="utf-8") as trace_file:
+        json.dump({"traceEvents": metadata + events}, trace_file)
+
+
+if enabled:
+    atexit.register(write, trace_path)
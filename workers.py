@@ -0,0 +1,98 @@
+import asyncio
+import inspect
+import traceback
+import deadlines
+import runtime
+import tracing
+
+from PySide6.QtCore import QObject, Signal
+
+
+class BackgroundTask(QObject):
+    """Runs a function on the shared asyncio runtime and hands the result back to the GUI thread.
+
+    Coroutine functions run on the runtime's event loop and blocking functions on its thread
+    pool, so no thread or event loop is started per task. Connect to `finished` and `error`
+    before calling `start()`. The signals are emitted from the runtime thread, so slots on
+    GUI objects are invoked through queued connections and are safe to touch widgets from.
+
+    The task runs within the budget of `stage` if given, see deadlines.stage_budgets, and
+    never past the deadline of whoever started it. `error` is emitted with a
+    deadlines.DeadlineExceeded if it runs out of time. `cancel()` stops the task, `error`
+    is then emitted with an asyncio.CancelledError."""
+
+    finished = Signal(object)
+    error = Signal(object)
+    # Set just before a result is emitted, for tracing.handoff_received on the GUI side
+    handoff: dict = None
+
+    # Every task started and not finished yet, for cancel_all
+    active = set()
+
+    def __init__(self, function, *args, stage: str = None):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.stage = stage
+        self.future = None
+        self.task: asyncio.Task = None
+
+    def start(self):
+        # The runtime thread doesn't share this thread's context, so the deadline is
+        # worked out here and handed over
+        if self.stage is not None:
+            deadline = deadlines.deadline_for(self.stage)
+        else:
+            deadline = deadlines.current()
+
+        BackgroundTask.active.add(self)
+        self.future = runtime.submit(self.run(deadline))
+        self.future.add_done_callback(
+            lambda _future: BackgroundTask.active.discard(self)
+        )
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+    @classmethod
+    def cancel_all(cls, timeout: float = deadlines.cancel_timeout):
+        """Cancels every running task and waits for them to release what they hold,
+        like a browser process, for at most `timeout` seconds"""
+        tasks = [task.task for task in list(cls.active) if task.task is not None]
+        if not tasks:
+            return
+
+        async def cancel():
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks, timeout=timeout)
+
+        try:
+            runtime.submit(cancel()).result(timeout + 1)
+        except Exception:
+            pass
+
+    async def run(self, deadline: float = None):
+        self.task = asyncio.current_task()
+        if deadline is not None:
+            deadlines.set_deadline(deadline)
+
+        try:
+            async with tracing.async_span(self.function.__name__, "task"):
+                if inspect.iscoroutinefunction(self.function):
+                    result = await self.function(*self.args)
+                else:
+                    result = await asyncio.to_thread(self.function, *self.args)
+        except asyncio.CancelledError as e:
+            self.handoff = tracing.handoff(f"{self.function.__name__} cancelled")
+            self.error.emit(e)
+            raise
+        except Exception as e:
+            print(traceback.format_exc())
+            self.handoff = tracing.handoff(f"{self.function.__name__} error")
+            self.error.emit(e)
+            return
+
+        self.handoff = tracing.handoff(f"{self.function.__name__} finished")
+        self.finished.emit(result)